@@ -0,0 +1,116 @@
+import gc
+import math
+import os
+import statistics
+import time
+from dataclasses import asdict, dataclass
+
+
+@dataclass(frozen=True)
+class BenchmarkConfig:
+    warmup: int = 3
+    min_iterations: int = 10
+    max_iterations: int = 100
+    # Stop once the confidence interval of the mean is within target_relative_error of the mean
+    confidence: float = 0.95
+    target_relative_error: float = 0.02
+    disable_gc: bool = False
+    cpu: int | None = None
+
+    def __post_init__(self):
+        # At least one timed call is needed for the statistics
+        if self.warmup < 0 or self.min_iterations < 1 or self.max_iterations < 1:
+            raise ValueError(f"warmup must be >= 0 and min_iterations/max_iterations >= 1, got {self}")
+        if not 0 < self.confidence < 1:
+            raise ValueError(f"confidence must be between 0 and 1, got {self.confidence}")
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# Runs the function exactly once - used when only the filter output is needed
+SINGLE_SHOT = BenchmarkConfig(warmup=0, min_iterations=1, max_iterations=1)
+
+
+def is_sampled(index, fraction):
+    # Picks exactly floor(n * fraction) of the consecutive indices 1..n. Image ids are hashes (discovery.stable_id),
+    # for them it is a stable pseudo-random pick of about fraction of the images.
+    return math.floor(index * fraction) != math.floor((index - 1) * fraction)
+
+
+@dataclass
+class TimingStats:
+    iterations: int
+    min: float
+    median: float
+    p95: float
+    mean: float
+    stddev: float
+
+    @classmethod
+    def from_samples(cls, samples: list[float]) -> "TimingStats":
+        ordered = sorted(samples)
+        return cls(
+            iterations=len(ordered),
+            min=ordered[0],
+            median=statistics.median(ordered),
+            p95=ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)],
+            mean=statistics.fmean(ordered),
+            stddev=statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _timer_overhead(samples=1000):
+    overhead = None
+    for i in range(samples):
+        start = time.perf_counter_ns()
+        end = time.perf_counter_ns()
+        overhead = end - start if overhead is None else min(overhead, end - start)
+    return overhead
+
+
+TIMER_OVERHEAD_NS = _timer_overhead()
+
+
+def _converged(samples, config, z):
+    if len(samples) < max(config.min_iterations, 2):
+        return False
+    mean = statistics.fmean(samples)
+    if mean == 0:
+        return True
+    half_width = z * statistics.stdev(samples) / math.sqrt(len(samples))
+    return half_width / mean <= config.target_relative_error
+
+
+def measure(func, *args, config=BenchmarkConfig(), **kwargs):
+    z = statistics.NormalDist().inv_cdf((1 + config.confidence) / 2)
+    previous_affinity = None
+    if config.cpu is not None and hasattr(os, "sched_setaffinity"):
+        previous_affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, {config.cpu})
+    gc_was_enabled = gc.isenabled()
+    if config.disable_gc:
+        gc.collect()
+        gc.disable()
+
+    try:
+        result = None
+        for i in range(config.warmup):
+            result = func(*args, **kwargs)
+
+        samples = []
+        while len(samples) < config.max_iterations and not _converged(samples, config, z):
+            start = time.perf_counter_ns()
+            result = func(*args, **kwargs)
+            end = time.perf_counter_ns()
+            samples.append(max(end - start - TIMER_OVERHEAD_NS, 0) / 1e9)
+    finally:
+        if config.disable_gc and gc_was_enabled:
+            gc.enable()
+        if previous_affinity is not None:
+            os.sched_setaffinity(0, previous_affinity)
+
+    return result, TimingStats.from_samples(samples)
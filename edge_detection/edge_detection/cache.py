@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from functools import lru_cache
+import numpy as np
+from . import filters
+
+# Content-addressed cache of filter outputs. A filter result is keyed by the hash of the input file, the filter
+# name, filters.VERSIONS[name] and the precision, so a rerun only recomputes inputs or filters that changed.
+# Entries also record the benchmark settings of their times; a benchmarked image does not reuse times measured
+# with other settings.
+MANIFEST_VERSION = 1
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_hash(array):
+    digest = hashlib.sha256(str((array.shape, array.dtype.str)).encode())
+    digest.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+    return digest.hexdigest()
+
+
+def filter_key(input_hash, filter_name, precision):
+    return f"{input_hash}-{filter_name}-v{filters.VERSIONS[filter_name]}-{precision}"
+
+
+class RerunCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.manifest = {"version": MANIFEST_VERSION, "filters": {}, "variants": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.manifest = manifest
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def lookup(self, key):
+        entry = self.manifest["filters"].get(key)
+        if entry is None or not os.path.exists(os.path.join(self.blob_dir, entry["blob"])):
+            return None
+        return {**entry, "last_used": time.time()}
+
+    def restore(self, entry, path):
+        shutil.copyfile(os.path.join(self.blob_dir, entry["blob"]), path)
+
+    def store(self, key, path, **values):
+        blob = key + os.path.splitext(path)[1]
+        temporary_path = os.path.join(self.blob_dir, f".{blob}.{os.getpid()}")
+        shutil.copyfile(path, temporary_path)
+        os.replace(temporary_path, os.path.join(self.blob_dir, blob))
+        return {"blob": blob, "size": os.path.getsize(path), "last_used": time.time(), **values}
+
+    def update(self, entries):
+        self.manifest["filters"].update(entries)
+
+    def variants_up_to_date(self, source_path, source_hash, variant_paths):
+        entry = self.manifest["variants"].get(os.path.abspath(source_path))
+        return (entry is not None and entry["hash"] == source_hash
+                and all(os.path.exists(path) for path in variant_paths))
+
+    def record_variants(self, source_path, source_hash):
+        self.manifest["variants"][os.path.abspath(source_path)] = {"hash": source_hash, "last_used": time.time()}
+
+    def evict(self):
+        # Least recently used first: entries not touched by the current run go before anything it used
+        entries = self.manifest["filters"]
+        total = sum(entry["size"] for entry in entries.values())
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]["last_used"]):
+            blob_path = os.path.join(self.blob_dir, entry["blob"])
+            if total <= self.max_bytes and os.path.exists(blob_path):
+                continue
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+            total -= entry["size"]
+            del entries[key]
+
+    def save(self):
+        temporary_path = f"{self.manifest_path}.{os.getpid()}"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(temporary_path, self.manifest_path)
+
+
+@lru_cache(maxsize=None)
+def open_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    # One instance per process; pool workers only read from it and hand their new entries back to run()
+    return RerunCache(cache_dir, max_bytes)
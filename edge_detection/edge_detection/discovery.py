@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Input discovery. Directories are listed with os.scandir, level by level and in parallel, to any depth. The
+# result is persisted as a work index holding every directory's mtime, its image files and subdirectories.
+# A rerun only stats the indexed directories and lists again the ones whose mtime changed (a file was added,
+# removed or renamed in them), so an unchanged corpus is not rescanned.
+INDEX_VERSION = 3
+# Formats cv.imread decodes
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+# Rasters that tiled runs read block by block (tiling.open_raster); other runs leave them out
+RASTER_EXTENSIONS = (".npy",)
+INDEXED_EXTENSIONS = IMAGE_EXTENSIONS + RASTER_EXTENSIONS
+SCAN_THREADS = 8
+
+# Variant names written by process_images: <file id>_<high_res|low_res>_<original|snp|gauss>
+VARIANT_NAME = re.compile(r"^(?P<file_id>.+)_(?P<resolution>high_res|low_res)_(?P<noise>original|snp|gauss)$")
+# Other names are split into tokens, so e.g. "mountain" does not count as containing "ai"
+TOKEN_SEPARATORS = re.compile(r"[_\-.\s]+")
+
+
+def parse_name(img_name):
+    stem = os.path.splitext(os.path.basename(img_name))[0]
+    match = VARIANT_NAME.match(stem)
+    if match:
+        file_id, resolution, noise = match.group("file_id", "resolution", "noise")
+        tokens = TOKEN_SEPARATORS.split(file_id.lower())
+    else:
+        file_id = stem
+        tokens = TOKEN_SEPARATORS.split(stem.lower())
+        joined = f"_{'_'.join(tokens)}_"
+        resolution = "high_res" if "_high_res_" in joined else "low_res" if "_low_res_" in joined else None
+        noise = "gauss" if "gauss" in tokens else "snp" if "snp" in tokens else "original"
+    return {
+        "file_id": file_id,
+        "resolution": resolution,
+        "noise": noise,
+        "is_high_resolution": resolution == "high_res",
+        "is_ai_generated": "ai" in tokens,
+        "is_gauss_noise": noise == "gauss",
+        "is_salt_and_pepper_noise": noise == "snp",
+    }
+
+
+def stable_id(input_dir, img_name):
+    # Derived from the image's path below input/ only, so it does not depend on which other images exist or on
+    # the traversal order. 48 bits keep it exact in JSON readers that use doubles.
+    key = "/".join([*input_dir.replace("\\", "/").split("/"), img_name]).lstrip("/")
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:6], "big")
+
+
+def is_image(name, extensions=IMAGE_EXTENSIONS):
+    return name.lower().endswith(extensions)
+
+
+def image_files(directory, extensions=IMAGE_EXTENSIONS):
+    # Sorted names of the image files directly in directory; scandir knows the entry types without a stat each
+    with os.scandir(directory) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file() and is_image(entry.name, extensions))
+
+
+def _list_dir(root, rel_dir):
+    files, subdirs = [], []
+    with os.scandir(os.path.join(root, rel_dir)) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file() and is_image(entry.name, INDEXED_EXTENSIONS):
+                files.append(entry.name)
+    return {"mtime_ns": os.stat(os.path.join(root, rel_dir)).st_mtime_ns, "files": sorted(files),
+            "subdirs": sorted(subdirs)}
+
+
+def _refresh(root, rel_dir, previous):
+    entry = previous.get(rel_dir)
+    if entry is not None and os.stat(os.path.join(root, rel_dir)).st_mtime_ns == entry["mtime_ns"]:
+        return entry
+    return _list_dir(root, rel_dir)
+
+
+def scan(root, index=None, threads=SCAN_THREADS):
+    previous = index["dirs"] if index is not None and index.get("root") == os.path.abspath(root) else {}
+    dirs = {}
+    level = [""]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while level:
+            entries = list(executor.map(lambda rel_dir: _refresh(root, rel_dir, previous), level))
+            next_level = []
+            for rel_dir, entry in zip(level, entries):
+                dirs[rel_dir] = entry
+                next_level += [os.path.join(rel_dir, subdir) for subdir in entry["subdirs"]]
+            level = next_level
+    return {"version": INDEX_VERSION, "root": os.path.abspath(root), "dirs": dirs}
+
+
+def load_index(index_path):
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as index_file:
+        index = json.load(index_file)
+    return index if index.get("version") == INDEX_VERSION else None
+
+
+def save_index(index, index_path):
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    temporary_path = f"{index_path}.{os.getpid()}"
+    with open(temporary_path, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(temporary_path, index_path)
+
+
+def update_index(root, index_path):
+    index = scan(root, load_index(index_path))
+    save_index(index, index_path)
+    return index
+
+
+def indexed_images(index, extensions=IMAGE_EXTENSIONS):
+    # (relative directory, file name) of every image, directories in sorted path order
+    return [(rel_dir, name) for rel_dir in sorted(index["dirs"], key=lambda rel_dir: rel_dir.split(os.sep))
+            for name in index["dirs"][rel_dir]["files"] if is_image(name, extensions)]
@@ -1,92 +1,405 @@
+import multiprocessing
 import os.path
-import time
-from os import listdir
-from os.path import join, isfile
+import tempfile
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from functools import partial
+from . import benchmark
+from . import cache as rerun_cache
+from . import discovery
 from . import filters
+from . import filter_bank
+from . import profiling
 from . import image_result
+from . import quality
+from . import results_store
+from . import tiling
+from . import workspace as filter_workspace
+from . import writer as image_writer
 import cv2 as cv
-import json
+import numpy as np
 
-NUMBER_OF_ITERATIONS_FOR_T_MEASUREMENT = 100
+BASE_DIR = os.path.join(".")
+JSON_DUMP_PATH = os.path.join("output")
+WORK_INDEX_PATH = os.path.join("..", "output", "work_index.json")
+# Raw outputs keep each filter's native dtype next to the 8-bit JPEG preview; read them with tiling.open_raster
+RAW_EXTENSION = ".npy"
+
+
+def raw_path(path):
+    return os.path.splitext(path)[0] + RAW_EXTENSION
+
+
+def output_name(img_name):
+    # The 8-bit outputs keep the input's name; a .npy raster gets a JPEG preview instead
+    stem, extension = os.path.splitext(img_name)
+    return stem + ".jpg" if extension.lower() == RAW_EXTENSION else img_name
 
 def save_after_filter(path, img, name, time):
-    cv.imwrite(path, img)
+    # Encoded and written in the background, see writer.py
+    image_writer.get_writer().submit(path, img)
     info = f"{name}: execution time = {time:.8f}s"
     # print(info)
 
 
-def apply_filter(filter_name, filter_func, img, paths):
-    start = time.monotonic()
-    for i in range(NUMBER_OF_ITERATIONS_FOR_T_MEASUREMENT):
-        filtered_img = filter_func(img)
-    end = time.monotonic()
-    execution_time = end - start
-    start = time.monotonic()
-    for i in range(NUMBER_OF_ITERATIONS_FOR_T_MEASUREMENT):
-        continue
-    end = time.monotonic()
-    execution_time = execution_time - (end - start)
-    save_after_filter(paths[filter_name], filtered_img, filter_name, execution_time)
-    return execution_time
-
-
-def run():
-    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    BASE_DIR = os.path.join(".")
-    json_dump_path = os.path.join("output")
-    image_id = 0
-    results = []
+def apply_filter(filter_name, filter_func, img, paths, config, owns_output=True):
+    with profiling.span("filter", filter_name):
+        filtered_img, stats = benchmark.measure(filter_func, img, config=config)
+    if not owns_output:
+        # The output is a workspace buffer the next filter call overwrites, the writer gets its own copy
+        filtered_img = filtered_img.copy()
+    save_after_filter(paths[filter_name], filtered_img, filter_name, stats.median)
+    return filtered_img, stats
+
+
+def apply_filter_bank(img, paths, precision, config, names=None):
+    execution_times = {}
+    with profiling.span("filter", "filter_bank"):
+        filtered_imgs, stats = benchmark.measure(filter_bank.apply_filter_bank, img, names=names,
+                                                 precision=precision, timings=execution_times, config=config)
+    # The per-filter split of the bank is only available as a sum over all calls, warm-up included
+    calls = config.warmup + stats.iterations
+    for filter_name, filtered_img in filtered_imgs.items():
+        execution_times[filter_name] /= calls
+        save_after_filter(paths[filter_name], filtered_img, filter_name, execution_times[filter_name])
+    return filtered_imgs, execution_times, stats
+
+
+def _init_worker(core_counter, cores, profiling_settings):
+    # Keep per-filter timings comparable with a serial run: one OpenCV thread per worker, one core per worker
+    cv.setNumThreads(1)
+    profiling.configure(**profiling_settings)
+    if cores and hasattr(os, "sched_setaffinity"):
+        # sched_setaffinity(0) only pins the calling thread: the writer's threads, started first, encode on any core
+        image_writer.get_writer()
+        with core_counter.get_lock():
+            index = core_counter.value
+            core_counter.value += 1
+        os.sched_setaffinity(0, {cores[index % len(cores)]})
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def collect_tasks(index_path=WORK_INDEX_PATH, extensions=discovery.IMAGE_EXTENSIONS):
+    # input_dir is the directory of the image relative to input/, at any depth
     input_path = os.path.join(BASE_DIR, "input")
-    input_dirs = os.listdir(input_path)
-    for input_dir in input_dirs:
-        input_path = os.path.join(BASE_DIR, "input", input_dir)
-        images = [f for f in listdir(input_path) if isfile(join(input_path, f))]
-        for image in images:
-
-            image_id += 1
-            img_original_path = os.path.join("..", "edge_detection", "input", input_dir, image)
-            img_name = image
-
-            paths = {"img": os.path.join(input_path, img_name),
-                     **{key: os.path.join("..", "output", input_dir, key, img_name) for key in
-                        filters.FILTERS.keys()},
-                     "json_dump": os.path.join("..", "output", input_dir)}
-
-            for key in paths:
-                os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
-
-            img = cv.imread(paths["img"], cv.IMREAD_GRAYSCALE)
-            height, width = img.shape
-
-            execution_times = {}
-            # Apply each filter (defined in filters.py)
-            for filter_name, filter_func in filters.FILTERS.items():
-                execution_times[filter_name] = apply_filter(filter_name, filter_func, img, paths)
-
-            results.append(image_result.ImageResult(
-                id=image_id,
-                original_path=img_original_path,
-                is_high_resolution="high_res" in img_name,
-                is_ai_generated = "ai" in img_name,
-                is_gauss_noise = "gauss" in img_name,
-                is_salt_and_pepper_noise = "snp" in img_name,
-                roberts_path=paths["roberts"],
-                prewitt_path=paths["prewitt"],
-                sobel_path=paths["sobel"],
-                robinson_path=paths["robinson"],
-                laplace_path=paths["laplacian"],
-                canny_path=paths["canny"],
-                time_roberts=execution_times["roberts"],
-                time_prewitt=execution_times["prewitt"],
-                time_sobel=execution_times["sobel"],
-                time_robinson=execution_times["robinson"],
-                time_laplace=execution_times["laplacian"],
-                time_canny=execution_times["canny"],
-                width=width,
-                height=height
-            ))
-
-    output_json_path = os.path.join("..", json_dump_path, "results.json")
-    os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
-    with open(output_json_path, "w") as json_file:
-        json.dump([result.to_dict() for result in results], json_file, indent=4)
+    with profiling.span("discover", "collect_tasks"):
+        index = discovery.update_index(input_path, index_path)
+    # The last element is the decoded image for in-memory tasks, None means it is read from input/
+    tasks = [(discovery.stable_id(input_dir, image), input_dir, image, None)
+             for input_dir, image in discovery.indexed_images(index, extensions)]
+    if len({task[0] for task in tasks}) != len(tasks):
+        raise ValueError("Two input images have the same id, rename one of them")
+    if len({(input_dir, output_name(image)) for _, input_dir, image, _ in tasks}) != len(tasks):
+        raise ValueError("Two input images would be written to the same outputs, rename one of them")
+    return tasks
+
+
+def ordered_map(executor, func, tasks, window):
+    # Like executor.map, but keeps at most window tasks in flight, so a stream of in-memory images is not
+    # consumed all at once
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(func, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def map_tasks(stack, process, tasks, workers):
+    # Serial map, or a pool of pinned workers entered on stack that returns results in submission order
+    if workers <= 1:
+        return map(process, tasks)
+    cores = available_cores()
+    # More workers than cores would make them compete for CPU time and inflate the measured times
+    workers = min(workers, len(cores))
+    core_counter = multiprocessing.Value("i", 0)
+    executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                       initargs=(core_counter, cores, profiling.settings())))
+    if profiling.enabled():
+        return _merge_spans(ordered_map(executor, partial(profiling.call_collecting, process), tasks,
+                                        window=4 * workers))
+    # Results come back in submission order, so the stored order matches the serial run
+    return ordered_map(executor, process, tasks, window=4 * workers)
+
+
+def _merge_spans(processed):
+    for result, events in processed:
+        profiling.add_events(events)
+        yield result
+
+
+def filter_image(img, names, paths, precision, use_filter_bank, benchmark_config):
+    if use_filter_bank:
+        filtered_imgs, execution_times, bank_stats = apply_filter_bank(img, paths, precision, benchmark_config,
+                                                                       names)
+        timing_stats = {"filter_bank": bank_stats.to_dict()}
+    else:
+        filtered_imgs = {}
+        execution_times = {}
+        timing_stats = {}
+        # The filters reuse the buffers of this process's workspace across iterations and images of a shape
+        workspace = filter_workspace.get_workspace()
+        # Apply each filter (defined in filters.py)
+        for filter_name in names:
+            filter_func = partial(filters.FILTERS[filter_name], precision=precision, workspace=workspace)
+            filtered_imgs[filter_name], stats = apply_filter(filter_name, filter_func, img, paths, benchmark_config,
+                                                             owns_output=False)
+            execution_times[filter_name] = stats.median
+            timing_stats[filter_name] = stats.to_dict()
+        workspace.trim()
+    return filtered_imgs, execution_times, timing_stats
+
+
+def filter_image_tiled(img, names, paths, raw_paths, tile_size, precision, benchmark_config):
+    # Every filter writes block by block into a memory-mapped .npy output that all iterations reuse: the raw
+    # output, or a scratch file removed once the image is done. The JPEG is a preview assembled tile by tile, so
+    # neither the input nor any output is held in memory as a whole.
+    filter_funcs = tiling.tiled_filters(tile_size)
+    workspace = filter_workspace.get_workspace()
+    writer = image_writer.get_writer()
+    filtered_imgs, execution_times, timing_stats, scratch_paths = {}, {}, {}, []
+    for filter_name in names:
+        writer.ensure_dir(os.path.dirname(paths[filter_name]))
+        target = raw_paths.get(filter_name)
+        if target is None:
+            handle, target = tempfile.mkstemp(suffix=RAW_EXTENSION, dir=os.path.dirname(paths[filter_name]))
+            os.close(handle)
+            scratch_paths.append(target)
+        out = np.lib.format.open_memmap(target, mode="w+", shape=img.shape[:2],
+                                        dtype=tiling.output_dtype(filter_name, img, precision))
+        filter_func = partial(filter_funcs[filter_name], precision=precision, workspace=workspace, out=out)
+        with profiling.span("filter", filter_name):
+            filtered_imgs[filter_name], stats = benchmark.measure(filter_func, img, config=benchmark_config)
+        out.flush()
+        with profiling.span("encode", f"{filter_name} preview"):
+            preview = tiling.preview(out, tile_size)
+        save_after_filter(paths[filter_name], preview, filter_name, stats.median)
+        execution_times[filter_name] = stats.median
+        timing_stats[filter_name] = stats.to_dict()
+    workspace.trim()
+    return filtered_imgs, execution_times, timing_stats, scratch_paths
+
+
+def process_image(task, tile_size=None, precision="float64", use_filter_bank=False,
+                  benchmark_config=benchmark.BenchmarkConfig(), timing_fraction=1.0, cache_dir=None,
+                  flush_writes=False, inline_metrics=False, edge_metrics=False, raw_outputs=False):
+    image_id, input_dir, img_name, img = task
+    sampled = benchmark.is_sampled(image_id, timing_fraction)
+    if not sampled:
+        # Not benchmarked: every filter runs once and time_* hold that single call
+        benchmark_config = benchmark.SINGLE_SHOT
+    input_path = os.path.join(BASE_DIR, "input", input_dir)
+    img_original_path = os.path.join("..", "edge_detection", "input", input_dir, img_name)
+
+    paths = {"img": os.path.join(input_path, img_name),
+             **{key: os.path.join("..", "output", input_dir, key, output_name(img_name)) for key in
+                filters.FILTERS.keys()},
+             "json_dump": os.path.join("..", "output", input_dir)}
+    raw_paths = {name: raw_path(paths[name]) for name in filters.FILTERS} if raw_outputs else {}
+
+    writer = image_writer.get_writer()
+    write_errors = []
+    scratch_paths = []
+    cached = {}
+    cache_updates = {}
+    if cache_dir:
+        cache = rerun_cache.open_cache(cache_dir)
+        input_hash = rerun_cache.file_hash(paths["img"]) if img is None else rerun_cache.array_hash(img)
+        keys = {name: rerun_cache.filter_key(input_hash, name, precision) for name in filters.FILTERS}
+        timing = _timing_settings(benchmark_config, tile_size, use_filter_bank)
+        for filter_name, key in keys.items():
+            entry = cache.lookup(key)
+            if sampled and entry is not None and entry.get("timing") != timing:
+                # The output is the same, but its time was measured differently than this run measures
+                entry = None
+            if inline_metrics and entry is not None and not _has_metrics(entry, filter_name, edge_metrics):
+                entry = None
+            raw_entry = cache.lookup(_raw_key(key)) if raw_outputs and entry is not None else None
+            if raw_outputs and raw_entry is None:
+                entry = None
+            if entry is not None:
+                writer.ensure_dir(os.path.dirname(paths[filter_name]))
+                cache.restore(entry, paths[filter_name])
+                cached[filter_name] = cache_updates[key] = entry
+                if raw_entry is not None:
+                    cache.restore(raw_entry, raw_paths[filter_name])
+                    cache_updates[_raw_key(key)] = raw_entry
+
+    missing = [name for name in filters.FILTERS if name not in cached]
+    if inline_metrics and missing and "canny" not in missing:
+        # The metrics compare against the in-memory Canny output
+        missing.append("canny")
+        del cached["canny"]
+    if missing:
+        if img is None:
+            with profiling.span("decode", img_name):
+                img = (tiling.open_raster(paths["img"]) if tile_size
+                       else cv.imread(paths["img"], cv.IMREAD_GRAYSCALE))
+        height, width = img.shape[:2]
+        with image_writer.held_while_timing(sampled):
+            if tile_size:
+                # The raw outputs are written by the filters themselves
+                filtered_imgs, execution_times, timing_stats, scratch_paths = filter_image_tiled(
+                    img, missing, paths, raw_paths, tile_size, precision, benchmark_config)
+            else:
+                filtered_imgs, execution_times, timing_stats = filter_image(img, missing, paths, precision,
+                                                                            use_filter_bank, benchmark_config)
+                for filter_name in raw_paths.keys() & filtered_imgs.keys():
+                    writer.submit(raw_paths[filter_name], filtered_imgs[filter_name])
+        # Computed from the outputs in their own dtype, before the 8-bit JPEG encoding
+        metrics = {}
+        if inline_metrics:
+            with profiling.span("metrics", img_name):
+                metrics = (tiling.tiled_image_metrics(filtered_imgs, tile_size, edge_metrics=edge_metrics)
+                           if tile_size else quality.image_metrics(filtered_imgs, edge_metrics=edge_metrics))
+        del filtered_imgs
+    else:
+        # Every filter output was restored from the cache, the image does not need to be decoded
+        entry = next(iter(cached.values()))
+        height, width = entry["height"], entry["width"]
+        execution_times, timing_stats, metrics = {}, {}, {}
+
+    for filter_name, entry in cached.items():
+        execution_times[filter_name] = entry["time"]
+        if entry["stats"] is not None:
+            timing_stats[filter_name] = entry["stats"]
+        if inline_metrics and filter_name in entry.get("metrics", {}):
+            metrics[filter_name] = entry["metrics"][filter_name]
+    if cache_dir and missing:
+        # The outputs are copied into the cache, so they have to be on disk first
+        write_errors += writer.flush()
+        for filter_name in missing:
+            cache_updates[keys[filter_name]] = cache.store(keys[filter_name], paths[filter_name],
+                                                           time=execution_times[filter_name],
+                                                           stats=timing_stats.get(filter_name),
+                                                           metrics={filter_name: metrics[filter_name]}
+                                                           if filter_name in metrics else {},
+                                                           metrics_version=quality.METRICS_VERSION,
+                                                           width=width, height=height, timing=timing)
+            if raw_outputs:
+                raw_key = _raw_key(keys[filter_name])
+                cache_updates[raw_key] = cache.store(raw_key, raw_paths[filter_name])
+
+    for scratch_path in scratch_paths:
+        os.remove(scratch_path)
+    if flush_writes:
+        write_errors += writer.flush()
+
+    name_metadata = discovery.parse_name(img_name)
+    return image_result.ImageResult(
+        id=image_id,
+        original_path=img_original_path,
+        **{flag: name_metadata[flag] for flag in
+           ("is_high_resolution", "is_ai_generated", "is_gauss_noise", "is_salt_and_pepper_noise")},
+        **{path_field: paths[name] for name, (path_field, _) in image_result.RESULT_FIELDS.items()},
+        **{time_field: execution_times[name] for name, (_, time_field) in image_result.RESULT_FIELDS.items()},
+        width=width,
+        height=height,
+        timing_stats=timing_stats,
+        metrics=metrics,
+        raw_paths=raw_paths,
+        other_filters={name: {"path": paths[name], "time": execution_times[name]} for name in filters.FILTERS
+                       if name not in image_result.RESULT_FIELDS}
+    ), cache_updates, write_errors
+
+
+def _raw_key(key):
+    return f"{key}-raw"
+
+
+def _timing_settings(benchmark_config, tile_size, use_filter_bank):
+    # What the cached times depend on; the CPU a run is pinned to is left out
+    return {**benchmark_config.to_dict(), "cpu": None, "tile_size": tile_size,
+            "filter_bank": filter_bank.VERSION if use_filter_bank else None}
+
+
+def checkpoint(store, cache=None):
+    # Results only reach the disk after their images, so a resumed run never skips an image it did not write.
+    # When a write failed, the pending results are dropped instead: it is not known which of them it belonged to.
+    with profiling.span("write", "checkpoint"):
+        write_errors = image_writer.get_writer().flush()
+        if write_errors:
+            store.discard_pending()
+        store.flush(sync=True)
+        if cache is not None:
+            cache.save()
+    return write_errors
+
+
+def _has_metrics(entry, filter_name, edge_metrics):
+    if filter_name == "canny":
+        return True
+    entry_metrics = entry.get("metrics", {}).get(filter_name)
+    return (entry_metrics is not None and entry.get("metrics_version") == quality.METRICS_VERSION
+            and (not edge_metrics or "f1" in entry_metrics))
+
+
+def run(workers=1, tile_size=None, precision="float64", use_filter_bank=False,
+        benchmark_config=benchmark.BenchmarkConfig(), timing_fraction=1.0, cache_dir=None,
+        cache_max_bytes=rerun_cache.DEFAULT_MAX_BYTES, tasks=None, export_json=True, inline_metrics=False,
+        edge_metrics=False, raw_outputs=False, resume=False, checkpoint_every=results_store.DEFAULT_FLUSH_EVERY):
+    # Every checkpoint_every results the images written so far, the results and the cache manifest are made
+    # durable together. With resume=True the results of a previous, interrupted run are kept and only the
+    # images missing from them are processed; image ids are stable, so the output matches a fresh run.
+    if tile_size and use_filter_bank:
+        raise ValueError("The filter bank works on whole images and cannot be combined with tiling")
+    if workers > 1:
+        # Workers are already pinned to their own core by _init_worker
+        benchmark_config = replace(benchmark_config, cpu=None)
+
+    if tasks is None:
+        # .npy rasters can only be read block by block, which only tiled runs do
+        tasks = collect_tasks(extensions=discovery.IMAGE_EXTENSIONS + discovery.RASTER_EXTENSIONS if tile_size
+                              else discovery.IMAGE_EXTENSIONS)
+    results_dir = os.path.join("..", JSON_DUMP_PATH, "results")
+    resumed = resume and results_store.exists(results_dir)
+    if resumed:
+        done = set(results_store.ResultsStore(results_dir).column("id").tolist())
+        tasks = (task for task in tasks if task[0] not in done)
+    # Pool workers finish their writes before returning an image; a serial run flushes once at the end
+    process = partial(process_image, tile_size=tile_size, precision=precision, use_filter_bank=use_filter_bank,
+                      benchmark_config=benchmark_config, timing_fraction=timing_fraction, cache_dir=cache_dir,
+                      flush_writes=workers > 1, inline_metrics=inline_metrics, edge_metrics=edge_metrics,
+                      raw_outputs=raw_outputs)
+
+    output_json_path = os.path.join("..", JSON_DUMP_PATH, "results.json")
+    cache = rerun_cache.open_cache(cache_dir) if cache_dir else None
+    write_errors = []
+
+    with ExitStack() as stack:
+        processed = map_tasks(stack, process, tasks, workers)
+        # Every result is appended to the results store as soon as it is done
+        store = stack.enter_context(results_store.ResultsWriter(results_dir, flush_every=None, resume=resumed))
+        # Entered after the store, so it also runs before the store is closed when the run is interrupted
+        stack.callback(lambda: write_errors.extend(checkpoint(store, cache)))
+        for result, cache_updates, errors in processed:
+            if errors:
+                # Some image of this result, or of a pending one, was not written
+                store.discard_pending()
+            else:
+                with profiling.span("write", "results_store"):
+                    store.append(result)
+            write_errors += errors
+            if cache is not None:
+                cache.update(cache_updates)
+            if store.pending_count >= checkpoint_every:
+                write_errors += checkpoint(store, cache)
+
+    if cache is not None:
+        cache.max_bytes = cache_max_bytes
+        cache.evict()
+        cache.save()
+
+    if export_json:
+        with profiling.span("write", "results.json"):
+            results_store.ResultsStore(results_dir).export_json(output_json_path)
+
+    image_writer.raise_errors(write_errors)
@@ -0,0 +1,20 @@
+import time
+from . import filters
+
+# Applies several filters to one image in a single call, so they are timed as one unit. Every filter is its
+# filters.FILTERS entry: computing Roberts, Prewitt, Robinson and Canny from shared intermediates (the 3x3 Sobel
+# gradients, a float copy of the image) was not faster than the filters on their own, and Canny was slower, since
+# the shared gradients needed their border redone for it. Bump VERSION whenever the way the bank computes its
+# filters changes, so cached bank timings are measured again.
+VERSION = 2
+
+
+def apply_filter_bank(img, names=None, precision="float64", timings=None):
+    names = filters.FILTERS.keys() if names is None else names
+    outputs = {}
+    for name in names:
+        start = time.perf_counter()
+        outputs[name] = filters.FILTERS[name](img, precision=precision)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start
+    return outputs
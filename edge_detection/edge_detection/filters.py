@@ -1,45 +1,169 @@
+import itertools
+from collections.abc import Mapping
+from dataclasses import dataclass, field
 import numpy as np
 from scipy import ndimage
 import cv2 as cv
+from .workspace import buffer
 
-FILTERS = {
-    "roberts": lambda img: roberts_filter(image=img),
-    "prewitt": lambda img: prewitt_filter(image=img),
-    "sobel": lambda img: cv.Sobel(src=img, ddepth=cv.CV_64F, dx=1, dy=1, ksize=5),
-    "robinson": lambda img: robinson_filter(image=img),
-    "laplacian": lambda img: cv.Laplacian(src=img, ddepth=cv.CV_16S, ksize=3),
-    "canny": lambda img: cv.Canny(image=img, threshold1=100, threshold2=200),
-}
-
-def prewitt_filter(image):
-    image = image.astype('float64')
-    image /= 255.0
-    prewitt_h = ndimage.prewitt(image, axis=0)
-    prewitt_v = ndimage.prewitt(image, axis=1)
-    magnitude = np.sqrt(prewitt_h ** 2 + prewitt_v ** 2)
+# Arithmetic used for the intermediate gradients. float64 is the reference; int16 is exact for 8-bit input,
+# magnitudes computed from int16 gradients are taken in float32.
+PRECISIONS = ("float64", "float32", "int16")
+DEPTHS = {"float64": cv.CV_64F, "float32": cv.CV_32F, "int16": cv.CV_16S}
+OUTPUT_DTYPES = {"float64": np.float64, "float32": np.float32, "int16": np.int16}
+
+def float_dtype(precision):
+    return np.float64 if precision == "float64" else np.float32
+
+def normalize(magnitude):
     magnitude *= 255 / np.max(magnitude)  # Normalization
     return magnitude
 
-def roberts_filter(image):
-    g_x = np.array([[1, 0], [0, -1]])
-    g_y = np.array([[0, 1], [-1, 0]])
-    gradient_x = cv.filter2D(image, cv.CV_64F, g_x)
-    gradient_y = cv.filter2D(image, cv.CV_64F, g_y)
-    roberts = np.sqrt(gradient_x ** 2 + gradient_y ** 2)
-    return roberts
-
-def robinson_filter(image):
-    masks =  np.array([[[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]],
-             [[0, 1, 2], [-1, 0, 1], [-2, -1, 0]],
-             [[1, 2, 1], [0, 0, 0], [-1, -2, -1]],
-             [[2, 1, 0], [1, 0, -1], [0, -1, -2]],
-             [[1, 0, -1], [2, 0, -2], [1, 0, -1]],
-             [[0, -1, -2], [1, 0, -1], [2, 1, 0]],
-             [[-1, -2, -1], [0, 0, 0], [1, 2, 1]],
-             [[-2, -1, 0], [-1, 0, 1], [0, 1, 2]]])
-    edges = []
-    for mask in masks:
-        edges.append(np.abs(cv.filter2D(image, cv.CV_64F, mask)))
-    robinson = np.maximum.reduce(edges)
-    robinson *= 255 / np.max(robinson)  # Normalization
-    return robinson
\ No newline at end of file
+def magnitude(gradient_x, gradient_y):
+    # sqrt(x ** 2 + y ** 2) computed in the buffers of the gradients; the result is in gradient_x's buffer
+    np.multiply(gradient_x, gradient_x, out=gradient_x)
+    np.multiply(gradient_y, gradient_y, out=gradient_y)
+    gradient_x += gradient_y
+    return np.sqrt(gradient_x, out=gradient_x)
+
+def _to_float32(gradient, name, workspace):
+    converted = buffer(workspace, name, gradient.shape, np.float32)
+    np.copyto(converted, gradient)
+    return converted
+
+def prewitt_magnitude(image, precision="float64", workspace=None):
+    if precision == "int16":
+        # Integer gradients are exact; the /255 scaling is dropped since normalization cancels it
+        prewitt_h = ndimage.prewitt(image, axis=0, output=buffer(workspace, "prewitt_h16", image.shape, np.int16))
+        prewitt_v = ndimage.prewitt(image, axis=1, output=buffer(workspace, "prewitt_v16", image.shape, np.int16))
+        prewitt_h = _to_float32(prewitt_h, "prewitt_h", workspace)
+        prewitt_v = _to_float32(prewitt_v, "prewitt_v", workspace)
+    else:
+        dtype = float_dtype(precision)
+        scaled = buffer(workspace, "prewitt_image", image.shape, dtype)
+        np.copyto(scaled, image)
+        scaled /= 255.0
+        prewitt_h = ndimage.prewitt(scaled, axis=0, output=buffer(workspace, "prewitt_h", image.shape, dtype))
+        prewitt_v = ndimage.prewitt(scaled, axis=1, output=buffer(workspace, "prewitt_v", image.shape, dtype))
+    return magnitude(prewitt_h, prewitt_v)
+
+def prewitt_filter(image, precision="float64", workspace=None):
+    return normalize(prewitt_magnitude(image, precision, workspace))
+
+ROBERTS_X = np.array([[1, 0], [0, -1]])
+ROBERTS_Y = np.array([[0, 1], [-1, 0]])
+
+def roberts_filter(image, precision="float64", workspace=None):
+    depth, dtype = DEPTHS[precision], OUTPUT_DTYPES[precision]
+    gradient_x = cv.filter2D(image, depth, ROBERTS_X, dst=buffer(workspace, "roberts_x", image.shape, dtype))
+    gradient_y = cv.filter2D(image, depth, ROBERTS_Y, dst=buffer(workspace, "roberts_y", image.shape, dtype))
+    if precision == "int16":
+        gradient_x = _to_float32(gradient_x, "roberts_x32", workspace)
+        gradient_y = _to_float32(gradient_y, "roberts_y32", workspace)
+    return magnitude(gradient_x, gradient_y)
+
+# Only the first four compass masks are needed: the other four are their negations and give the same |response|
+ROBINSON_MASKS = np.array([[[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]],
+                           [[0, 1, 2], [-1, 0, 1], [-2, -1, 0]],
+                           [[1, 2, 1], [0, 0, 0], [-1, -2, -1]],
+                           [[2, 1, 0], [1, 0, -1], [0, -1, -2]]])
+
+def robinson_magnitude(image, precision="float64", workspace=None):
+    depth, dtype = DEPTHS[precision], OUTPUT_DTYPES[precision]
+    robinson = cv.filter2D(image, depth, ROBINSON_MASKS[0], dst=buffer(workspace, "robinson", image.shape, dtype))
+    np.abs(robinson, out=robinson)
+    response = buffer(workspace, "robinson_response", image.shape, dtype)
+    for mask in ROBINSON_MASKS[1:]:
+        response = cv.filter2D(image, depth, mask, dst=response)
+        np.abs(response, out=response)
+        np.maximum(robinson, response, out=robinson)
+    if precision == "int16":
+        robinson = _to_float32(robinson, "robinson32", workspace)
+    return robinson
+
+def robinson_filter(image, precision="float64", workspace=None):
+    return normalize(robinson_magnitude(image, precision, workspace))
+
+def sobel_filter(image, precision="float64", dx=1, dy=1, ksize=5, workspace=None):
+    return cv.Sobel(src=image, ddepth=DEPTHS[precision], dx=dx, dy=dy, ksize=ksize,
+                    dst=buffer(workspace, "sobel", image.shape, OUTPUT_DTYPES[precision]))
+
+def laplacian_filter(image, precision="float64", ksize=3, workspace=None):
+    return cv.Laplacian(src=image, ddepth=cv.CV_16S, ksize=ksize,
+                        dst=buffer(workspace, "laplacian", image.shape, np.int16))
+
+def canny_filter(image, precision="float64", threshold1=100, threshold2=200, aperture_size=3, l2_gradient=False,
+                 workspace=None):
+    return cv.Canny(image=image, threshold1=threshold1, threshold2=threshold2, apertureSize=aperture_size,
+                    L2gradient=l2_gradient, edges=buffer(workspace, "canny", image.shape, np.uint8))
+
+
+# Every filter is called as func(img, precision=..., **params), plus workspace=... to reuse buffers (see
+# workspace.py); params holds the declared parameters and their defaults. Bump a filter's version whenever its
+# output changes, so cached results of the old version are recomputed.
+@dataclass(frozen=True)
+class FilterSpec:
+    name: str
+    func: object
+    params: dict = field(default_factory=dict)
+    version: int = 1
+
+    def bind(self, **params):
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise ValueError(f"{self.name} has no parameters {sorted(unknown)}, declared: {sorted(self.params)}")
+        bound = {**self.params, **params}
+
+        def filter_func(img, precision="float64", workspace=None):
+            if workspace is None:
+                return self.func(img, precision=precision, **bound)
+            return self.func(img, precision=precision, workspace=workspace, **bound)
+        return filter_func
+
+
+REGISTRY = {}
+
+def register_filter(name, func, version=1, **params):
+    REGISTRY[name] = FilterSpec(name, func, params, version)
+    return REGISTRY[name]
+
+def variant_name(name, params):
+    # Default parameters are left out, so the default variant of a filter is named like the filter itself
+    changed = {key: value for key, value in sorted(params.items()) if REGISTRY[name].params[key] != value}
+    return "_".join([name, *(f"{key}={value}" for key, value in changed.items())])
+
+def parameter_grid(name, grid):
+    # grid maps parameter names to the values to try; every combination is one variant
+    spec = REGISTRY[name]
+    unknown = set(grid) - set(spec.params)
+    if unknown:
+        raise ValueError(f"{name} has no parameters {sorted(unknown)}, declared: {sorted(spec.params)}")
+    keys = list(grid)
+    return [{**spec.params, **dict(zip(keys, values))} for values in itertools.product(*(grid[key] for key in keys))]
+
+
+register_filter("roberts", roberts_filter)
+register_filter("prewitt", prewitt_filter)
+register_filter("sobel", sobel_filter, dx=1, dy=1, ksize=5)
+register_filter("robinson", robinson_filter)
+register_filter("laplacian", laplacian_filter, ksize=3)
+register_filter("canny", canny_filter, threshold1=100, threshold2=200, aperture_size=3, l2_gradient=False)
+
+class RegistryView(Mapping):
+    # Read-only mapping over REGISTRY, so filters registered after import are part of it
+    def __init__(self, value):
+        self.value = value
+
+    def __getitem__(self, name):
+        return self.value(REGISTRY[name])
+
+    def __iter__(self):
+        return iter(REGISTRY)
+
+    def __len__(self):
+        return len(REGISTRY)
+
+
+# The default variant of every registered filter
+FILTERS = RegistryView(lambda spec: spec.bind())
+VERSIONS = RegistryView(lambda spec: spec.version)
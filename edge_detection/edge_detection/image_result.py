@@ -1,8 +1,22 @@
-from dataclasses import asdict, dataclass
+import os
+from dataclasses import asdict, dataclass, field, fields
 from PIL import Image
 
+PATH_FIELDS = ["original_path", "roberts_path", "prewitt_path", "sobel_path", "robinson_path", "laplace_path",
+               "canny_path"]
+# Filter name: (path field, time field) of its output in ImageResult
+RESULT_FIELDS = {"roberts": ("roberts_path", "time_roberts"), "prewitt": ("prewitt_path", "time_prewitt"),
+                 "sobel": ("sobel_path", "time_sobel"), "robinson": ("robinson_path", "time_robinson"),
+                 "laplacian": ("laplace_path", "time_laplace"), "canny": ("canny_path", "time_canny")}
 
-@dataclass
+
+def probe_size(path):
+    # PIL only reads the header here, the pixel data is never decoded
+    with Image.open(path) as image:
+        return image.size
+
+
+@dataclass(slots=True)
 class ImageResult:
     id: int
     original_path: str
@@ -16,41 +30,74 @@ class ImageResult:
     robinson_path: str
     laplace_path: str
     canny_path: str
-    time_roberts: int
-    time_prewitt: int
-    time_sobel: int
-    time_robinson: int
-    time_laplace: int
-    time_canny: int
+    time_roberts: float
+    time_prewitt: float
+    time_sobel: float
+    time_robinson: float
+    time_laplace: float
+    time_canny: float
+    width: int
+    height: int
+    # Per filter: iterations, min, median, p95, mean and stddev of a single call in seconds
+    timing_stats: dict = field(default_factory=dict)
+    # Per filter, computed against Canny during edge detection: mse, psnr, ssim and optionally precision/recall/f1
+    metrics: dict = field(default_factory=dict)
+    # Per filter, the .npy file with its native-dtype output; empty unless raw outputs were requested
+    raw_paths: dict = field(default_factory=dict)
+    # Per registered filter without fields of its own in RESULT_FIELDS: the path and time of its output
+    other_filters: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: dict, normalize_paths: bool = False) -> "ImageResult":
+        values = {name: data[name] for name in FIELD_NAMES if name in data}
+        if normalize_paths:
+            for name in PATH_FIELDS:
+                values[name] = values[name].replace(os.sep, "/")
+            if "raw_paths" in values:
+                values["raw_paths"] = {key: path.replace(os.sep, "/") for key, path in values["raw_paths"].items()}
+            if "other_filters" in values:
+                values["other_filters"] = {key: {**output, "path": output["path"].replace(os.sep, "/")}
+                                           for key, output in values["other_filters"].items()}
+        # The stored size is trusted; the image is only opened for results written without one
+        if values.get("width") is None or values.get("height") is None:
+            values["width"], values["height"] = probe_size(data["original_path"])
+        return cls(**values)
+
+    @classmethod
+    def from_dicts(cls, items: list[dict], normalize_paths: bool = False) -> list["ImageResult"]:
+        return [cls.from_dict(data, normalize_paths) for data in items]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# One filter variant applied to one image. Unlike ImageResult it does not depend on which filters exist, so it
+# is the record used for parameter sweeps.
+@dataclass(slots=True)
+class FilterResult:
+    image_id: int
+    original_path: str
+    filter: str
+    # Filter name followed by the parameters that differ from the defaults, see filters.variant_name
+    variant: str
+    # Every parameter of the variant, defaults included
+    params: dict
+    path: str
+    time: float
     width: int
     height: int
+    # Pyramid level the filter ran on: 0 is the input image, every further level halves its size
+    level: int = 0
+    timing_stats: dict = field(default_factory=dict)
+    metrics: dict = field(default_factory=dict)
 
     @classmethod
-    def from_dict(cls, data: dict) -> "ImageResult":
-        image = Image.open(data["original_path"])
-        width, height = image.size
-        return cls(
-            id=data["id"],
-            original_path=data["original_path"],
-            is_high_resolution=data["is_high_resolution"],
-            is_ai_generated=data["is_ai_generated"],
-            is_gauss_noise=data["is_gauss_noise"],
-            is_salt_and_pepper_noise=data["is_salt_and_pepper_noise"],
-            roberts_path=data["roberts_path"],
-            prewitt_path=data["prewitt_path"],
-            sobel_path=data["sobel_path"],
-            robinson_path=data["robinson_path"],
-            laplace_path=data["laplace_path"],
-            canny_path=data["canny_path"],
-            time_roberts=data["time_roberts"],
-            time_prewitt=data["time_prewitt"],
-            time_sobel=data["time_sobel"],
-            time_robinson=data["time_robinson"],
-            time_laplace=data["time_laplace"],
-            time_canny=data["time_canny"],
-            width=width,
-            height=height
-        )
+    def from_dict(cls, data: dict) -> "FilterResult":
+        return cls(**{name: data[name] for name in FILTER_FIELD_NAMES if name in data})
 
     def to_dict(self) -> dict:
-        return asdict(self)
\ No newline at end of file
+        return asdict(self)
+
+
+FIELD_NAMES = [result_field.name for result_field in fields(ImageResult)]
+FILTER_FIELD_NAMES = [result_field.name for result_field in fields(FilterResult)]
@@ -0,0 +1,45 @@
+import os
+import cv2 as cv
+from . import discovery
+from . import edge_detection
+from . import profiling
+from . import writer as image_writer
+from image_preprocess import noise
+from image_preprocess.process_images import generate_variants
+
+# Streaming mode: variants are generated in memory and handed straight to the filters instead of being written
+# to input/ and decoded again. Writing them is optional and happens on a background writer.
+
+
+def stream_tasks(photo_folders, output_base_folder, seed=noise.DEFAULT_SEED, writer=None):
+    # Ids are the stable ids of the written variants, and the order is that of collect_tasks() (as long as no
+    # photo name is a prefix of another one)
+    for folder, photo_folder in sorted(photo_folders.items()):
+        output_folder = os.path.join(output_base_folder, folder)
+        variants = []
+        for filename in discovery.image_files(photo_folder, (".jpg",)):
+            file_id = os.path.splitext(filename)[0]
+            with profiling.span("decode", filename):
+                image = cv.imread(os.path.join(photo_folder, filename))
+            if image is None:
+                print(f"Warning: Could not load image {os.path.join(photo_folder, filename)}. Skipping...")
+                continue
+            with profiling.span("preprocess", file_id):
+                for variant, variant_image in generate_variants(image, file_id, seed):
+                    variants.append((f"{file_id}_{variant}.jpg", variant_image))
+                    if writer is not None:
+                        writer.submit(os.path.join(output_folder, f"{file_id}_{variant}.jpg"), variant_image)
+
+            # Names are emitted once a photo is complete, in the order a directory listing would be sorted
+            for img_name, variant_image in sorted(variants, key=lambda item: item[0]):
+                yield discovery.stable_id(folder, img_name), folder, img_name, cv.cvtColor(variant_image, cv.COLOR_BGR2GRAY)
+            variants = []
+
+
+def run_streaming(photo_folders, output_base_folder, seed=noise.DEFAULT_SEED, write_variants=True, **run_kwargs):
+    writer = image_writer.AsyncImageWriter() if write_variants else None
+    try:
+        edge_detection.run(tasks=stream_tasks(photo_folders, output_base_folder, seed, writer), **run_kwargs)
+    finally:
+        if writer is not None:
+            image_writer.raise_errors(writer.close())
@@ -0,0 +1,44 @@
+import argparse
+import numpy as np
+import cv2 as cv
+from . import benchmark
+from . import filters
+from .quality import to_saved_image
+
+REFERENCE_PRECISION = "float64"
+
+
+def precision_report(img, precisions=filters.PRECISIONS, config=benchmark.BenchmarkConfig()):
+    report = {}
+    for filter_name, filter_func in filters.FILTERS.items():
+        reference = filter_func(img, precision=REFERENCE_PRECISION).astype(np.float64)
+        saved_reference = to_saved_image(reference)
+        report[filter_name] = {}
+        for precision in precisions:
+            filtered_img, stats = benchmark.measure(filter_func, img, precision=precision, config=config)
+            report[filter_name][precision] = {
+                "max_deviation": float(np.max(np.abs(filtered_img.astype(np.float64) - reference))),
+                "max_saved_deviation": int(np.max(np.abs(
+                    to_saved_image(filtered_img).astype(np.int16) - saved_reference.astype(np.int16)))),
+                "time": stats.median,
+            }
+    return report
+
+
+def format_report(report):
+    lines = [f"{'filter':<10} {'precision':<10} {'max deviation':>14} {'max saved deviation':>20} {'median [s]':>12}"]
+    for filter_name, precisions in report.items():
+        for precision, values in precisions.items():
+            lines.append(f"{filter_name:<10} {precision:<10} {values['max_deviation']:>14.6g} "
+                         f"{values['max_saved_deviation']:>20} {values['time']:>12.6f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare filter precisions against the float64 reference")
+    parser.add_argument("images", nargs="+")
+    args = parser.parse_args()
+
+    for image_path in args.images:
+        print(image_path)
+        print(format_report(precision_report(cv.imread(image_path, cv.IMREAD_GRAYSCALE))))
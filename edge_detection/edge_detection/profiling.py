@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Named spans around the stages of the pipeline, exported as a Chrome trace (chrome://tracing, Perfetto) and
+# summarized per stage. Profiling is off by default: span() then hands out one shared no-op context manager.
+# Pool workers collect their own spans, which are returned with every task and merged by map_tasks.
+STAGES = ("discover", "decode", "preprocess", "filter", "encode", "write", "metrics", "report")
+
+_settings = {"enabled": False, "memory": False}
+_events = []
+_lock = threading.Lock()
+# Open spans of the main thread, innermost last; only they take part in the memory high-water marks
+_memory_stack = []
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("stage", "name", "start", "peak", "tracks_memory")
+
+    def __init__(self, stage, name):
+        self.stage = stage
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self):
+        self.tracks_memory = _settings["memory"] and threading.current_thread() is threading.main_thread()
+        if self.tracks_memory:
+            # The peak reached so far belongs to the enclosing span, which is reset for this one
+            if _memory_stack:
+                _memory_stack[-1].peak = max(_memory_stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            _memory_stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        event = {"name": self.name, "cat": self.stage, "ph": "X", "ts": self.start / 1000,
+                 "dur": (end - self.start) / 1000, "pid": os.getpid(), "tid": threading.get_ident()}
+        if self.tracks_memory:
+            _memory_stack.pop()
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if _memory_stack:
+                _memory_stack[-1].peak = max(_memory_stack[-1].peak, self.peak)
+            event["args"] = {"peak_bytes": self.peak}
+        with _lock:
+            _events.append(event)
+        return False
+
+
+def span(stage, name=None):
+    if not _settings["enabled"]:
+        return NULL_SPAN
+    return Span(stage, stage if name is None else name)
+
+
+def enabled():
+    return _settings["enabled"]
+
+
+def settings():
+    return dict(_settings)
+
+
+def configure(enabled=True, memory=False):
+    _settings["enabled"] = enabled
+    _settings["memory"] = enabled and memory
+    if _settings["memory"] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def drain():
+    # Returns the spans recorded since the last call and forgets them
+    global _events
+    with _lock:
+        events, _events = _events, []
+    return events
+
+
+def add_events(events):
+    with _lock:
+        _events.extend(events)
+
+
+def call_collecting(func, task):
+    # Runs func in a pool worker and hands the spans it recorded back to the parent together with its result
+    return func(task), drain()
+
+
+def export_chrome_trace(path, events):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+def summarize(events):
+    summary = {}
+    for event in events:
+        stage = summary.setdefault(event["cat"], {"count": 0, "total": 0.0, "max": 0.0, "peak_bytes": None})
+        duration = event["dur"] / 1e6
+        stage["count"] += 1
+        stage["total"] += duration
+        stage["max"] = max(stage["max"], duration)
+        if "args" in event:
+            stage["peak_bytes"] = max(stage["peak_bytes"] or 0, event["args"]["peak_bytes"])
+    for stage in summary.values():
+        stage["mean"] = stage["total"] / stage["count"]
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["total"]))
+
+
+def format_summary(summary):
+    # Nested spans are counted in their own stage and again in the enclosing one
+    lines = [f"{'stage':<12} {'count':>8} {'total [s]':>12} {'mean [s]':>12} {'max [s]':>12} {'peak [MiB]':>11}"]
+    for stage, values in summary.items():
+        peak = "" if values["peak_bytes"] is None else f"{values['peak_bytes'] / 1024 ** 2:.1f}"
+        lines.append(f"{stage:<12} {values['count']:>8} {values['total']:>12.6f} {values['mean']:>12.6f} "
+                     f"{values['max']:>12.6f} {peak:>11}")
+    return "\n".join(lines)
+
+
+def finish(trace_path):
+    # Exports everything recorded in this process (and merged from its workers) and prints the summary
+    events = drain()
+    export_chrome_trace(trace_path, events)
+    print(format_summary(summarize(events)))
+    return events
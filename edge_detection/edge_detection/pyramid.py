@@ -0,0 +1,105 @@
+import os
+import time
+from contextlib import ExitStack
+from dataclasses import replace
+from functools import partial
+import cv2 as cv
+from . import benchmark
+from . import edge_detection
+from . import filters
+from . import profiling
+from . import quality
+from . import results_store
+from . import writer as image_writer
+from .image_result import FilterResult
+
+# Multi-scale mode: every input image is decoded once and reduced into a pyramid, each level resized from the
+# level above it. The filter bank runs on every level in memory and each (image, level, filter) triple is stored
+# as one FilterResult record.
+PYRAMID_DIR = os.path.join("..", "output", "pyramid")
+DEFAULT_LEVELS = 4
+# Levels smaller than this on either side are not built
+MIN_LEVEL_SIZE = 16
+
+
+def build_pyramid(img, levels=DEFAULT_LEVELS, timings=None):
+    # Same halving as the low resolution variants of process_images, but every level starts from the previous one
+    pyramid = [img]
+    while len(pyramid) < levels:
+        previous = pyramid[-1]
+        height, width = previous.shape[:2]
+        if min(height, width) // 2 < MIN_LEVEL_SIZE:
+            break
+        start = time.perf_counter()
+        with profiling.span("preprocess", f"pyramid level {len(pyramid)}"):
+            pyramid.append(cv.resize(previous, (width // 2, height // 2)))
+        if timings is not None:
+            timings.append(time.perf_counter() - start)
+    return pyramid
+
+
+def pyramid_image(task, levels=DEFAULT_LEVELS, precision="float64", benchmark_config=benchmark.BenchmarkConfig(),
+                  timing_fraction=1.0, flush_writes=False, pyramid_dir=PYRAMID_DIR, inline_metrics=False,
+                  edge_metrics=False):
+    image_id, input_dir, img_name, img = task
+    sampled = benchmark.is_sampled(image_id, timing_fraction)
+    if not sampled:
+        benchmark_config = benchmark.SINGLE_SHOT
+    if img is None:
+        with profiling.span("decode", img_name):
+            img = cv.imread(os.path.join(edge_detection.BASE_DIR, "input", input_dir, img_name),
+                            cv.IMREAD_GRAYSCALE)
+    original_path = os.path.join("..", "edge_detection", "input", input_dir, img_name)
+
+    resize_times = [0.0]
+    results = []
+    with image_writer.held_while_timing(sampled):
+        for level, level_img in enumerate(build_pyramid(img, levels, resize_times)):
+            height, width = level_img.shape
+            paths = {name: os.path.join(pyramid_dir, input_dir, f"level_{level}", name, img_name)
+                     for name in filters.FILTERS}
+            filtered_imgs, execution_times, stats = edge_detection.apply_filter_bank(level_img, paths, precision,
+                                                                                     benchmark_config)
+            metrics = {}
+            if inline_metrics:
+                with profiling.span("metrics", img_name):
+                    metrics = quality.image_metrics(filtered_imgs, edge_metrics=edge_metrics)
+            for name in filters.FILTERS:
+                results.append(FilterResult(image_id=image_id, original_path=original_path, filter=name, variant=name,
+                                            params=dict(filters.REGISTRY[name].params), path=paths[name],
+                                            time=execution_times[name], width=width, height=height, level=level,
+                                            timing_stats={"filter_bank": stats.to_dict(),
+                                                          "resize": resize_times[level]},
+                                            metrics=metrics.get(name, {})))
+
+    write_errors = image_writer.get_writer().flush() if flush_writes else []
+    return results, write_errors
+
+
+def run_pyramid(levels=DEFAULT_LEVELS, workers=1, precision="float64", benchmark_config=benchmark.BenchmarkConfig(),
+                timing_fraction=1.0, tasks=None, export_json=True, pyramid_dir=PYRAMID_DIR, inline_metrics=False,
+                edge_metrics=False):
+    if workers > 1:
+        benchmark_config = replace(benchmark_config, cpu=None)
+
+    tasks = edge_detection.collect_tasks() if tasks is None else tasks
+    process = partial(pyramid_image, levels=levels, precision=precision, benchmark_config=benchmark_config,
+                      timing_fraction=timing_fraction, flush_writes=workers > 1, pyramid_dir=pyramid_dir,
+                      inline_metrics=inline_metrics, edge_metrics=edge_metrics)
+
+    results_dir = os.path.join(pyramid_dir, "results")
+    write_errors = []
+    with ExitStack() as stack:
+        processed = edge_detection.map_tasks(stack, process, tasks, workers)
+        store = stack.enter_context(results_store.ResultsWriter(results_dir,
+                                                                results_store.schema_for(FilterResult)))
+        for results, errors in processed:
+            for result in results:
+                store.append(result)
+            write_errors += errors
+    write_errors += image_writer.get_writer().flush()
+
+    if export_json:
+        results_store.ResultsStore(results_dir).export_json(os.path.join(pyramid_dir, "results.json"))
+
+    image_writer.raise_errors(write_errors)
@@ -0,0 +1,75 @@
+import numpy as np
+from skimage.metrics import structural_similarity as ssim
+
+# Quality metrics of a filter output against a reference output (Canny), on the exact output in its native dtype
+# brought to the reference's 0..255 scale. Bump METRICS_VERSION whenever the values change.
+EDGE_THRESHOLD = 128
+METRICS_VERSION = 2
+
+
+def to_saved_image(img):
+    # What cv.imwrite stores for an 8-bit JPEG: values rounded and saturated to 0..255
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+def to_metric_image(img, maximum=None):
+    # Signed responses (Sobel CV_64F, Laplacian CV_16S) count by their magnitude; outputs reaching above 255 are
+    # scaled down by their maximum instead of being saturated like cv.imwrite does, the others are kept as they are.
+    # For a tile of an output, maximum is the one of the whole output.
+    image = np.abs(img, dtype=np.float64)
+    maximum = np.max(image) if maximum is None else maximum
+    if maximum > 255:
+        image *= 255 / maximum
+    return image
+
+
+def mse(image1, image2):
+    # Widened before subtracting: uint8 differences would wrap around
+    difference = np.subtract(image1, image2, dtype=np.float64)
+    return float(np.mean(difference * difference))
+
+
+def psnr(image1, image2, max_pixel=255):
+    return psnr_from_mse(mse(image1, image2), max_pixel)
+
+
+def psnr_from_mse(mse_value, max_pixel=255):
+    if mse_value == 0:
+        return 100
+    return float(20 * np.log10(max_pixel / np.sqrt(mse_value)))
+
+
+def calculate_ssim(image1, image2):
+    return float(ssim(image1, image2, data_range=255))
+
+
+def compare(image, reference):
+    return {"mse": mse(image, reference), "psnr": psnr(image, reference), "ssim": calculate_ssim(image, reference)}
+
+
+def edge_scores(image, reference, threshold=EDGE_THRESHOLD):
+    # Pixels at or above the threshold count as edges, compared with the non-zero pixels of the reference
+    predicted = image >= threshold
+    actual = reference > 0
+    return edge_scores_from_counts(np.count_nonzero(predicted & actual), np.count_nonzero(predicted),
+                                   np.count_nonzero(actual))
+
+
+def edge_scores_from_counts(true_positives, predicted_count, actual_count):
+    precision = true_positives / predicted_count if predicted_count else 0.0
+    recall = true_positives / actual_count if actual_count else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def image_metrics(outputs, reference_name="canny", edge_metrics=False):
+    reference = to_metric_image(outputs[reference_name])
+    metrics = {}
+    for name, img in outputs.items():
+        if name == reference_name:
+            continue
+        image = to_metric_image(img)
+        metrics[name] = compare(image, reference)
+        if edge_metrics:
+            metrics[name].update(edge_scores(image, reference))
+    return metrics
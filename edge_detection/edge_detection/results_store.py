@@ -0,0 +1,176 @@
+import json
+import os
+import textwrap
+from dataclasses import fields
+import numpy as np
+from .image_result import ImageResult
+
+# Append-only columnar store of ImageResult (or other dataclass) records:
+#   schema.json  - column names and kinds
+#   records.bin  - fixed-size records of a numpy structured dtype, readable as a memory map
+#   strings.bin  - UTF-8 heap for str and json columns, referenced from the records by (offset, length)
+# Records are written while the run progresses, so a crash only loses the records since the last flush. A writer
+# opened with resume=True keeps the records already on disk and appends after them.
+SCHEMA_FILE = "schema.json"
+RECORDS_FILE = "records.bin"
+STRINGS_FILE = "strings.bin"
+DEFAULT_FLUSH_EVERY = 64
+
+STRING_REF = np.dtype([("offset", "<u8"), ("length", "<u4")])
+KINDS = {bool: "bool", int: "int", float: "float", str: "str", dict: "json"}
+DTYPES = {"bool": np.dtype("?"), "int": np.dtype("<i8"), "float": np.dtype("<f8"), "str": STRING_REF,
+          "json": STRING_REF}
+
+
+def schema_for(record_class):
+    return [[field.name, KINDS[field.type]] for field in fields(record_class)]
+
+
+def default_schema():
+    return schema_for(ImageResult)
+
+
+def record_dtype(schema):
+    return np.dtype([(name, DTYPES[kind]) for name, kind in schema])
+
+
+def exists(directory):
+    return os.path.exists(os.path.join(directory, SCHEMA_FILE))
+
+
+class ResultsWriter:
+    def __init__(self, directory, schema=None, flush_every=DEFAULT_FLUSH_EVERY, resume=False):
+        # flush_every=None leaves flushing to the caller
+        self.directory = directory
+        self.schema = default_schema() if schema is None else schema
+        self.dtype = record_dtype(self.schema)
+        self.flush_every = flush_every
+        records_path = os.path.join(directory, RECORDS_FILE)
+        strings_path = os.path.join(directory, STRINGS_FILE)
+        if resume and exists(directory):
+            with open(os.path.join(directory, SCHEMA_FILE), "r") as schema_file:
+                if json.load(schema_file)["columns"] != self.schema:
+                    raise ValueError(f"The results in {directory} have a different schema and cannot be resumed")
+            # A record cut short by a crash is dropped; strings it referenced are left unused in the heap
+            size = os.path.getsize(records_path)
+            with open(records_path, "r+b") as records_file:
+                records_file.truncate(size - size % self.dtype.itemsize)
+            self.records = open(records_path, "ab")
+            self.strings = open(strings_path, "ab")
+            self.string_offset = os.path.getsize(strings_path)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, SCHEMA_FILE), "w") as schema_file:
+                json.dump({"columns": self.schema}, schema_file)
+            self.records = open(records_path, "wb")
+            self.strings = open(strings_path, "wb")
+            self.string_offset = 0
+        self.pending = bytearray()
+        self.pending_count = 0
+
+    def _store_string(self, text):
+        encoded = text.encode("utf-8")
+        offset = self.string_offset
+        self.strings.write(encoded)
+        self.string_offset += len(encoded)
+        return offset, len(encoded)
+
+    def append(self, result):
+        data = result if isinstance(result, dict) else result.to_dict()
+        record = np.zeros(1, dtype=self.dtype)
+        for name, kind in self.schema:
+            value = data.get(name)
+            if kind == "str":
+                record[name] = self._store_string("" if value is None else value)
+            elif kind == "json":
+                record[name] = self._store_string(json.dumps(value))
+            elif value is not None:
+                record[name] = value
+            elif kind == "float":
+                record[name] = np.nan
+        self.pending += record.tobytes()
+        self.pending_count += 1
+        if self.flush_every is not None and self.pending_count >= self.flush_every:
+            self.flush()
+
+    def flush(self, sync=False):
+        # Strings go first, so every record on disk refers to strings that are already there
+        self.strings.flush()
+        if sync:
+            os.fsync(self.strings.fileno())
+        self.records.write(self.pending)
+        self.records.flush()
+        if sync:
+            os.fsync(self.records.fileno())
+        self.pending = bytearray()
+        self.pending_count = 0
+
+    def discard_pending(self):
+        # Drops the records appended since the last flush; the strings they referenced stay unused in the heap
+        self.pending = bytearray()
+        self.pending_count = 0
+
+    def close(self):
+        self.flush(sync=True)
+        self.records.close()
+        self.strings.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResultsStore:
+    def __init__(self, directory):
+        with open(os.path.join(directory, SCHEMA_FILE), "r") as schema_file:
+            self.schema = json.load(schema_file)["columns"]
+        self.kinds = dict(self.schema)
+        self.dtype = record_dtype(self.schema)
+        records_path = os.path.join(directory, RECORDS_FILE)
+        strings_path = os.path.join(directory, STRINGS_FILE)
+        # A record cut short by a crash is ignored
+        size = os.path.getsize(records_path) // self.dtype.itemsize
+        self.records = (np.memmap(records_path, dtype=self.dtype, mode="r", shape=(size,)) if size
+                        else np.zeros(0, dtype=self.dtype))
+        self.strings = (np.memmap(strings_path, dtype=np.uint8, mode="r") if os.path.getsize(strings_path)
+                        else np.zeros(0, dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.records)
+
+    def _strings(self, name):
+        refs = self.records[name]
+        return [self.strings[offset:offset + length].tobytes().decode("utf-8")
+                for offset, length in zip(refs["offset"].tolist(), refs["length"].tolist())]
+
+    def column(self, name):
+        kind = self.kinds[name]
+        if kind == "str":
+            return np.array(self._strings(name), dtype=object)
+        if kind == "json":
+            return [json.loads(text) for text in self._strings(name)]
+        return np.asarray(self.records[name])
+
+    def columns(self, names=None):
+        # Only the named columns are read and decoded, all of them by default
+        return {name: self.column(name) for name, kind in self.schema if names is None or name in names}
+
+    def to_dicts(self):
+        columns = {name: column if isinstance(column, list) else column.tolist()
+                   for name, column in self.columns().items()}
+        return [{name: columns[name][index] for name, kind in self.schema} for index in range(len(self))]
+
+    def export_json(self, json_path):
+        # Same layout as json.dump(..., indent=4) of the list of results, written one record at a time
+        with open(json_path, "w") as json_file:
+            rows = self.to_dicts()
+            if not rows:
+                json_file.write("[]")
+                return
+            json_file.write("[\n")
+            for index, row in enumerate(rows):
+                json_file.write(textwrap.indent(json.dumps(row, indent=4), "    "))
+                json_file.write(",\n" if index < len(rows) - 1 else "\n")
+            json_file.write("]")
@@ -0,0 +1,123 @@
+import ast
+import os
+from contextlib import ExitStack
+from dataclasses import replace
+from functools import partial
+import cv2 as cv
+from . import benchmark
+from . import edge_detection
+from . import filters
+from . import profiling
+from . import quality
+from . import results_store
+from . import workspace as filter_workspace
+from . import writer as image_writer
+from .image_result import FilterResult
+
+# Parameter sweeps: every variant of a parameter grid is applied to every input image. An image is decoded once
+# and shared by all of its variants; every (image, variant) pair is stored as one FilterResult record.
+SWEEP_DIR = os.path.join("..", "output", "sweep")
+
+
+def _parse_value(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_grid(specs):
+    # "canny:threshold1=50,100;threshold2=150,200" -> {"canny": {"threshold1": [50, 100], "threshold2": [150, 200]}}
+    grid = {}
+    for spec in specs:
+        name, _, params = spec.partition(":")
+        if name not in filters.REGISTRY:
+            raise ValueError(f"Unknown filter {name}, registered: {sorted(filters.REGISTRY)}")
+        grid.setdefault(name, {})
+        for param in filter(None, params.split(";")):
+            key, _, values = param.partition("=")
+            grid[name][key] = [_parse_value(value) for value in values.split(",")]
+    return grid
+
+
+def sweep_variants(grid):
+    # (filter name, parameters, variant name) of every combination, without duplicates
+    variants = {}
+    for name, params_grid in grid.items():
+        for params in filters.parameter_grid(name, params_grid):
+            variants.setdefault(filters.variant_name(name, params), (name, params))
+    return [(name, params, variant) for variant, (name, params) in variants.items()]
+
+
+def sweep_image(task, variants, precision="float64", benchmark_config=benchmark.BenchmarkConfig(),
+                timing_fraction=1.0, flush_writes=False, sweep_dir=SWEEP_DIR, inline_metrics=False,
+                edge_metrics=False):
+    image_id, input_dir, img_name, img = task
+    sampled = benchmark.is_sampled(image_id, timing_fraction)
+    if not sampled:
+        benchmark_config = benchmark.SINGLE_SHOT
+    if img is None:
+        with profiling.span("decode", img_name):
+            img = cv.imread(os.path.join(edge_detection.BASE_DIR, "input", input_dir, img_name),
+                            cv.IMREAD_GRAYSCALE)
+    height, width = img.shape
+    original_path = os.path.join("..", "edge_detection", "input", input_dir, img_name)
+    # Metrics compare every variant against the default Canny output
+    reference = quality.to_metric_image(filters.FILTERS["canny"](img)) if inline_metrics else None
+
+    writer = image_writer.get_writer()
+    workspace = filter_workspace.get_workspace()
+    results = []
+    for name, params, variant in variants:
+        filter_func = partial(filters.REGISTRY[name].bind(**params), precision=precision, workspace=workspace)
+        # Held for each variant rather than the whole image: a grid can have more variants than fit in memory
+        with profiling.span("filter", variant), image_writer.held_while_timing(sampled):
+            filtered_img, stats = benchmark.measure(filter_func, img, config=benchmark_config)
+        # Every variant of a filter writes into the same workspace buffer
+        filtered_img = filtered_img.copy()
+        path = os.path.join(sweep_dir, input_dir, variant, img_name)
+        writer.submit(path, filtered_img)
+        metrics = {}
+        if reference is not None:
+            with profiling.span("metrics", variant):
+                metric_image = quality.to_metric_image(filtered_img)
+                metrics = quality.compare(metric_image, reference)
+                if edge_metrics:
+                    metrics.update(quality.edge_scores(metric_image, reference))
+        results.append(FilterResult(image_id=image_id, original_path=original_path, filter=name, variant=variant,
+                                    params=params, path=path, time=stats.median, width=width, height=height,
+                                    timing_stats=stats.to_dict(), metrics=metrics))
+    workspace.trim()
+
+    write_errors = writer.flush() if flush_writes else []
+    return results, write_errors
+
+
+def run_sweep(grid, workers=1, precision="float64", benchmark_config=benchmark.BenchmarkConfig(),
+              timing_fraction=1.0, tasks=None, export_json=True, sweep_dir=SWEEP_DIR, inline_metrics=False,
+              edge_metrics=False):
+    variants = sweep_variants(grid)
+    if workers > 1:
+        benchmark_config = replace(benchmark_config, cpu=None)
+
+    tasks = edge_detection.collect_tasks() if tasks is None else tasks
+    process = partial(sweep_image, variants=variants, precision=precision, benchmark_config=benchmark_config,
+                      timing_fraction=timing_fraction, flush_writes=workers > 1, sweep_dir=sweep_dir,
+                      inline_metrics=inline_metrics, edge_metrics=edge_metrics)
+
+    results_dir = os.path.join(sweep_dir, "results")
+    write_errors = []
+    with ExitStack() as stack:
+        processed = edge_detection.map_tasks(stack, process, tasks, workers)
+        store = stack.enter_context(results_store.ResultsWriter(results_dir,
+                                                                results_store.schema_for(FilterResult)))
+        for results, errors in processed:
+            for result in results:
+                store.append(result)
+            write_errors += errors
+    write_errors += image_writer.get_writer().flush()
+
+    if export_json:
+        results_store.ResultsStore(results_dir).export_json(os.path.join(sweep_dir, "results.json"))
+
+    image_writer.raise_errors(write_errors)
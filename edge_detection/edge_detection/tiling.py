@@ -0,0 +1,166 @@
+from functools import partial
+import numpy as np
+import cv2 as cv
+from skimage.metrics import structural_similarity as ssim
+from . import filters
+from . import quality
+
+DEFAULT_TILE_SIZE = 1024
+# Longest side of the 8-bit JPEG preview of a tiled output; larger outputs are reduced by an integer factor
+PREVIEW_MAX_SIZE = 4096
+# Canny's gradients and non-maximum suppression only need 2 pixels around a tile, but hysteresis follows edges
+# across the whole image: an edge connected to a strong one only through pixels further than this from the tile
+# can be missing from the tiled output
+CANNY_HALO = 64
+# Half of the 7x7 window of skimage's structural_similarity
+SSIM_HALO = 3
+
+# name: (per-pixel part of the filter, halo in pixels, rescaled by the global maximum afterwards)
+# The halo is the kernel radius - every output pixel of a tile only depends on input pixels within it.
+TILED_FILTERS = {
+    "roberts": (filters.roberts_filter, 1, False),
+    "prewitt": (filters.prewitt_magnitude, 1, True),
+    "sobel": (filters.FILTERS["sobel"], 2, False),
+    "robinson": (filters.robinson_magnitude, 1, True),
+    "laplacian": (filters.FILTERS["laplacian"], 1, False),
+    "canny": (filters.FILTERS["canny"], CANNY_HALO, False),
+}
+
+
+def open_raster(path):
+    # .npy rasters are memory-mapped, so only the blocks being filtered are read from disk; other formats can only
+    # be decoded whole
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return cv.imread(path, cv.IMREAD_GRAYSCALE)
+
+
+def tiles(height, width, tile_size):
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield y, x, min(y + tile_size, height), min(x + tile_size, width)
+
+
+def apply_tiled(filter_func, image, halo, tile_size=DEFAULT_TILE_SIZE, normalized=False, out=None):
+    # out can be an np.lib.format.open_memmap array, then neither the input nor the output is held in memory
+    # as a whole
+    height, width = image.shape[:2]
+    maximum = None
+    for y0, x0, y1, x1 in tiles(height, width, tile_size):
+        top, left = max(y0 - halo, 0), max(x0 - halo, 0)
+        bottom, right = min(y1 + halo, height), min(x1 + halo, width)
+        block = filter_func(np.ascontiguousarray(image[top:bottom, left:right]))
+        block = block[y0 - top:y1 - top, x0 - left:x1 - left]
+        if out is None:
+            out = np.empty((height, width), dtype=block.dtype)
+        out[y0:y1, x0:x1] = block
+        if normalized:
+            block_max = np.max(block)
+            maximum = block_max if maximum is None else max(maximum, block_max)
+
+    if normalized:
+        # Same scale factor as filters.normalize, applied block by block
+        scale = 255 / maximum
+        for y0, x0, y1, x1 in tiles(height, width, tile_size):
+            out[y0:y1, x0:x1] *= scale
+    return out
+
+
+def _apply_whole(filter_func, image, precision="float64", workspace=None, out=None):
+    # Registered filters without a known halo are applied to the whole image
+    filtered = filter_func(image, precision=precision, workspace=workspace)
+    if out is None:
+        return filtered.copy() if workspace is not None else filtered
+    out[...] = filtered
+    return out
+
+
+def tiled_filters(tile_size=DEFAULT_TILE_SIZE):
+    # Called as func(img, precision=..., workspace=..., out=...); the workspace only holds the buffers of a block
+    tiled = {}
+    for name, filter_func in filters.FILTERS.items():
+        if name in TILED_FILTERS:
+            local_func, halo, normalized = TILED_FILTERS[name]
+            tiled[name] = (lambda img, precision="float64", workspace=None, out=None, f=local_func, h=halo,
+                           n=normalized:
+                           apply_tiled(partial(f, precision=precision, workspace=workspace), img, h, tile_size,
+                                       normalized=n, out=out))
+        else:
+            tiled[name] = partial(_apply_whole, filter_func)
+    return tiled
+
+
+def output_dtype(name, image, precision="float64"):
+    # The dtype of a filter's output, from a small corner of the image, so the output can be allocated up front
+    local_func = TILED_FILTERS[name][0] if name in TILED_FILTERS else filters.FILTERS[name]
+    return local_func(np.ascontiguousarray(image[:16, :16]), precision=precision).dtype
+
+
+def preview(raster, tile_size=DEFAULT_TILE_SIZE, max_size=PREVIEW_MAX_SIZE):
+    # The 8-bit image cv.imwrite would save for raster, assembled tile by tile. Rasters longer than max_size are
+    # reduced by an integer factor, each tile on its own; blocks are aligned to the factor so no output pixel
+    # spans two of them.
+    height, width = raster.shape[:2]
+    factor = max(1, -(-max(height, width) // max_size))
+    block_size = -(-tile_size // factor) * factor
+    out = np.empty((-(-height // factor), -(-width // factor)), dtype=np.uint8)
+    for y0, x0, y1, x1 in tiles(height, width, block_size):
+        block = quality.to_saved_image(raster[y0:y1, x0:x1])
+        if factor > 1:
+            block = cv.resize(block, (-(-(x1 - x0) // factor), -(-(y1 - y0) // factor)),
+                              interpolation=cv.INTER_AREA)
+        out[y0 // factor:y0 // factor + block.shape[0], x0 // factor:x0 // factor + block.shape[1]] = block
+    return out
+
+
+def _ssim_span(start, end, size):
+    # Rows (or columns) read for the SSIM of a tile: the halo around it, at least one whole window
+    low, high = max(start - SSIM_HALO, 0), min(end + SSIM_HALO, size)
+    if high - low < 2 * SSIM_HALO + 1:
+        low = max(min(low, high - 2 * SSIM_HALO - 1), 0)
+        high = min(max(high, low + 2 * SSIM_HALO + 1), size)
+    return low, high
+
+
+def tiled_image_metrics(outputs, tile_size=DEFAULT_TILE_SIZE, reference_name="canny", edge_metrics=False):
+    # quality.image_metrics computed tile by tile: MSE and the edge counts are sums over pixels, SSIM is the mean of
+    # its per-pixel map without the outer SSIM_HALO pixels, each pixel computed from a tile with its halo
+    reference_raster = outputs[reference_name]
+    height, width = reference_raster.shape[:2]
+    maxima = {name: max(float(np.max(np.abs(raster[y0:y1, x0:x1], dtype=np.float64)))
+                        for y0, x0, y1, x1 in tiles(height, width, tile_size))
+              for name, raster in outputs.items()}
+    names = [name for name in outputs if name != reference_name]
+    sums = {name: {"squared_error": 0.0, "ssim": 0.0, "true_positives": 0, "predicted": 0} for name in names}
+    actual_count = 0
+
+    for y0, x0, y1, x1 in tiles(height, width, tile_size):
+        top, bottom = _ssim_span(y0, y1, height)
+        left, right = _ssim_span(x0, x1, width)
+        tile = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+        # The part of the tile inside the region structural_similarity averages over
+        inner = (slice(max(y0, SSIM_HALO) - top, min(y1, height - SSIM_HALO) - top),
+                 slice(max(x0, SSIM_HALO) - left, min(x1, width - SSIM_HALO) - left))
+        reference = quality.to_metric_image(reference_raster[top:bottom, left:right], maxima[reference_name])
+        actual = reference[tile] > 0
+        actual_count += np.count_nonzero(actual)
+        for name in names:
+            image = quality.to_metric_image(outputs[name][top:bottom, left:right], maxima[name])
+            difference = image[tile] - reference[tile]
+            sums[name]["squared_error"] += float(np.sum(difference * difference))
+            _, ssim_map = ssim(image, reference, data_range=255, full=True)
+            sums[name]["ssim"] += float(np.sum(ssim_map[inner], dtype=np.float64))
+            if edge_metrics:
+                predicted = image[tile] >= quality.EDGE_THRESHOLD
+                sums[name]["true_positives"] += np.count_nonzero(predicted & actual)
+                sums[name]["predicted"] += np.count_nonzero(predicted)
+
+    metrics = {}
+    for name in names:
+        mse_value = sums[name]["squared_error"] / (height * width)
+        metrics[name] = {"mse": mse_value, "psnr": quality.psnr_from_mse(mse_value),
+                         "ssim": sums[name]["ssim"] / ((height - 2 * SSIM_HALO) * (width - 2 * SSIM_HALO))}
+        if edge_metrics:
+            metrics[name].update(quality.edge_scores_from_counts(sums[name]["true_positives"],
+                                                                 sums[name]["predicted"], actual_count))
+    return metrics
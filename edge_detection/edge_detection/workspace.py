@@ -0,0 +1,63 @@
+import os
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+
+# Reusable output and scratch buffers for the filters. A filter called with a workspace writes into buffers
+# named after itself instead of allocating new arrays, so repeated calls on images of the same shape (the
+# benchmark iterations, then the next images of a batch) do not allocate at all. The result of such a call is a
+# workspace buffer: it is overwritten by the next call and has to be copied before it is kept or handed to the
+# background writer.
+# The buffers are bounded by their total size: least recently used shapes are dropped first. The shape being
+# filtered is kept even when its buffers alone are over the limit, trim() drops it once the image is done.
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+
+class Workspace:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # shape: {(name, dtype): buffer}, least recently used shape first
+        self.shapes = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, name, shape, dtype):
+        shape = tuple(shape)
+        buffers = self.shapes.get(shape)
+        if buffers is None:
+            buffers = self.shapes[shape] = {}
+        else:
+            self.shapes.move_to_end(shape)
+        key = (name, np.dtype(dtype).str)
+        if key not in buffers:
+            buffers[key] = np.empty(shape, dtype=dtype)
+            self.nbytes += buffers[key].nbytes
+            self._evict(keep=shape)
+        return buffers[key]
+
+    def trim(self):
+        # Called after each image, so the next images do not carry the buffers of an oversized one
+        self._evict()
+
+    def _evict(self, keep=None):
+        for shape in list(self.shapes):
+            if self.nbytes <= self.max_bytes:
+                break
+            if shape != keep:
+                self.nbytes -= sum(buffer.nbytes for buffer in self.shapes.pop(shape).values())
+
+
+def buffer(workspace, name, shape, dtype):
+    # Without a workspace every call gets a new array, like the filters always did
+    if workspace is None:
+        return np.empty(shape, dtype=dtype)
+    return workspace.get(name, shape, dtype)
+
+
+@lru_cache(maxsize=None)
+def _process_workspace(pid, max_bytes):
+    return Workspace(max_bytes)
+
+
+def get_workspace(max_bytes=DEFAULT_MAX_BYTES):
+    # One workspace per process, shared by every image that process filters
+    return _process_workspace(os.getpid(), max_bytes)
@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+import cv2 as cv
+import numpy as np
+from . import profiling
+
+# Write-behind stage for output images: a bounded queue feeding encoder threads. cv.imwrite releases the GIL,
+# so encoding and disk I/O overlap with filtering. When the disk falls behind, submit() blocks until the queue
+# has room again. .npy paths are saved with np.save instead of being encoded. While filters are being timed, the
+# writer is held: its threads would otherwise compete with them for the CPU.
+DEFAULT_THREADS = 2
+DEFAULT_MAX_PENDING = 32
+
+
+class AsyncImageWriter:
+    def __init__(self, threads=DEFAULT_THREADS, max_pending=DEFAULT_MAX_PENDING):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.created_dirs = set()
+        self.lock = threading.Lock()
+        # Submissions kept back while the writer is held, None when it is not
+        self.held_items = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def ensure_dir(self, directory):
+        if directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+
+    def submit(self, path, img):
+        self.ensure_dir(os.path.dirname(path))
+        if self.held_items is not None:
+            self.held_items.append((path, img))
+        else:
+            self.queue.put((path, img))
+
+    @contextmanager
+    def held(self):
+        # Finishes the pending writes, then keeps new submissions back until the block ends, so nothing is encoded
+        # or written in the meantime. Errors stay collected for the next flush().
+        self.queue.join()
+        self.held_items = []
+        try:
+            yield self
+        finally:
+            items, self.held_items = self.held_items, None
+            for item in items:
+                self.queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, img = item
+                if path.endswith(".npy"):
+                    # Raw outputs are stored as they are, in their own dtype
+                    with profiling.span("write", path):
+                        np.save(path, img)
+                    continue
+                # Encoded and written separately, so the two show up as their own profiling stages
+                with profiling.span("encode", path):
+                    encoded, buffer = cv.imencode(os.path.splitext(path)[1], img)
+                if not encoded:
+                    raise OSError(f"cv.imencode could not encode {path}")
+                with profiling.span("write", path):
+                    with open(path, "wb") as image_file:
+                        image_file.write(buffer)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append(error)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # Waits for every submitted image and returns the errors collected since the last flush
+        self.queue.join()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def close(self):
+        errors = self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return errors
+
+
+@lru_cache(maxsize=None)
+def _process_writer(pid, threads, max_pending):
+    return AsyncImageWriter(threads, max_pending)
+
+
+def get_writer(threads=DEFAULT_THREADS, max_pending=DEFAULT_MAX_PENDING):
+    # One writer per process, shared by every image that process filters. Keyed by pid because a forked pool
+    # worker inherits the parent's writer object but not its threads.
+    return _process_writer(os.getpid(), threads, max_pending)
+
+
+def held_while_timing(sampled):
+    # The timings of a benchmarked image are taken with the process writer held; other images keep encoding
+    # alongside the filters
+    return get_writer().held() if sampled else nullcontext()
+
+
+def raise_errors(errors):
+    if errors:
+        details = "\n".join(str(error) for error in errors[:10])
+        raise RuntimeError(f"{len(errors)} image(s) could not be written:\n{details}")
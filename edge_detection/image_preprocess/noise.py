@@ -0,0 +1,63 @@
+import zlib
+import numpy as np
+
+DEFAULT_SEED = 0
+
+
+def variant_rng(seed, file_id, variant):
+    # Each (photo, variant) pair gets its own stream, so results do not depend on processing order
+    return np.random.default_rng([seed, zlib.crc32(file_id.encode()), zlib.crc32(variant.encode())])
+
+
+def _noise_counts(image_shape, salt_vs_pepper, amount):
+    size = int(np.prod(image_shape))
+    num_salt = int(np.ceil(amount * size * salt_vs_pepper))
+    num_pepper = int(np.ceil(amount * size * (1.0 - salt_vs_pepper)))
+    return num_salt, num_pepper
+
+
+def salt_and_pepper_noise(image, rng, salt_vs_pepper=0.5, amount=0.02, out=None):
+    # Works in place when out is image; otherwise the image is copied into the preallocated out buffer
+    if out is None:
+        out = np.empty_like(image)
+    if out is not image:
+        np.copyto(out, image)
+    rows, cols = image.shape[:2]
+    num_salt, num_pepper = _noise_counts(image.shape, salt_vs_pepper, amount)
+    out[rng.integers(0, rows, num_salt), rng.integers(0, cols, num_salt)] = 255
+    out[rng.integers(0, rows, num_pepper), rng.integers(0, cols, num_pepper)] = 0
+    return out
+
+
+def gaussian_noise(image, rng, mean=0, var=1, out=None, scratch=None):
+    # Noise is added in float32 and the sum is rounded and clipped, so negative samples darken instead of wrapping
+    if out is None:
+        out = np.empty_like(image)
+    if scratch is None or scratch.shape != image.shape:
+        scratch = np.empty(image.shape, dtype=np.float32)
+    rng.standard_normal(dtype=np.float32, out=scratch)
+    scratch *= var ** 0.5
+    scratch += mean
+    scratch += image
+    np.rint(scratch, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting="unsafe")
+    return out
+
+
+def salt_and_pepper_noise_batch(images, rng, salt_vs_pepper=0.5, amount=0.02, out=None):
+    # images: (N, rows, cols, ...) stack of same-sized images, every image gets the same amount of noise
+    if out is None:
+        out = np.empty_like(images)
+    if out is not images:
+        np.copyto(out, images)
+    count, rows, cols = images.shape[:3]
+    num_salt, num_pepper = _noise_counts(images.shape[1:], salt_vs_pepper, amount)
+    for value, number in ((255, num_salt), (0, num_pepper)):
+        index = np.repeat(np.arange(count), number)
+        out[index, rng.integers(0, rows, count * number), rng.integers(0, cols, count * number)] = value
+    return out
+
+
+def gaussian_noise_batch(images, rng, mean=0, var=1, out=None, scratch=None):
+    return gaussian_noise(images, rng, mean, var, out, scratch)
@@ -1,59 +1,83 @@
 import os
 import cv2
 import numpy as np
+from edge_detection import cache as rerun_cache
+from edge_detection import discovery, profiling
+from image_preprocess import noise
 
-def apply_salt_and_pepper_noise(image, salt_vs_pepper=0.5, amount=0.02):
-    row, col, _ = image.shape
-    num_salt = np.ceil(amount * image.size * salt_vs_pepper).astype(int)
-    num_pepper = np.ceil(amount * image.size * (1.0 - salt_vs_pepper)).astype(int)
+VARIANTS = ["high_res_original", "low_res_original", "high_res_snp", "low_res_snp", "high_res_gauss", "low_res_gauss"]
 
-    salt_coords = [np.random.randint(0, i - 1, num_salt) for i in image.shape[:2]]
-    pepper_coords = [np.random.randint(0, i - 1, num_pepper) for i in image.shape[:2]]
+def apply_salt_and_pepper_noise(image, salt_vs_pepper=0.5, amount=0.02, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    return noise.salt_and_pepper_noise(image, rng, salt_vs_pepper, amount)
 
-    noisy_image = image.copy()
-    noisy_image[salt_coords[0], salt_coords[1]] = 255
-    noisy_image[pepper_coords[0], pepper_coords[1]] = 0
+def apply_gaussian_noise(image, mean=0, var=1, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    return noise.gaussian_noise(image, rng, mean, var)
 
-    return noisy_image
+def _noise_buffers(buffers, image):
+    # One output and one float32 scratch buffer per image shape, reused for every photo of that size
+    if image.shape not in buffers:
+        buffers[image.shape] = (np.empty_like(image), np.empty(image.shape, dtype=np.float32))
+    return buffers[image.shape]
 
-def apply_gaussian_noise(image, mean=0, var=1):
-    sigma = var ** 0.5
-    gauss = np.random.normal(mean, sigma, image.shape).astype('uint8')
-    noisy_image = cv2.add(image, gauss)
-    return noisy_image
+def generate_variants(image, file_id, seed=noise.DEFAULT_SEED, buffers=None):
+    # Yields (variant, image) in VARIANTS order. With buffers the noisy variants share per-shape buffers,
+    # so each one has to be consumed before the next is requested; without them every variant is a new array.
+    def noise_buffers(variant_image):
+        return _noise_buffers(buffers, variant_image) if buffers is not None else (None, None)
 
-def process_images(input_folder, output_folder):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    # The high-resolution original
+    yield "high_res_original", image
 
-    for filename in os.listdir(input_folder):
-        if filename.endswith('.jpg'):
-            file_id = os.path.splitext(filename)[0]
-            image_path = os.path.join(input_folder, filename)
-            image = cv2.imread(image_path)
+    # Low-resolution version
+    low_res_image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2))
+    yield "low_res_original", low_res_image
 
-            if image is None:
-                print(f"Warning: Could not load image {image_path}. Skipping...")
-                continue
+    # Salt-and-pepper noise
+    for variant, variant_image in (("high_res_snp", image), ("low_res_snp", low_res_image)):
+        out, scratch = noise_buffers(variant_image)
+        yield variant, noise.salt_and_pepper_noise(variant_image, noise.variant_rng(seed, file_id, variant), out=out)
 
-            # Save the high-resolution original
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_high_res_original.jpg"), image)
+    # Gaussian noise
+    for variant, variant_image in (("high_res_gauss", image), ("low_res_gauss", low_res_image)):
+        out, scratch = noise_buffers(variant_image)
+        yield variant, noise.gaussian_noise(variant_image, noise.variant_rng(seed, file_id, variant), out=out,
+                                            scratch=scratch)
 
-            # Create and save low-resolution version
-            low_res_image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2))
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_low_res_original.jpg"), low_res_image)
+def process_images(input_folder, output_folder, cache_dir=None, seed=noise.DEFAULT_SEED):
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    cache = rerun_cache.open_cache(cache_dir) if cache_dir else None
+    buffers = {}
+
+    with profiling.span("discover", input_folder):
+        filenames = discovery.image_files(input_folder, ('.jpg',))
 
-            # Add salt-and-pepper noise and save
-            snp_image = apply_salt_and_pepper_noise(image)
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_high_res_snp.jpg"), snp_image)
+    for filename in filenames:
+        file_id = os.path.splitext(filename)[0]
+        image_path = os.path.join(input_folder, filename)
+        if cache is not None:
+            # Variants of an unchanged photo are kept, so their filter results stay cached as well
+            source_hash = f"{rerun_cache.file_hash(image_path)}-seed{seed}"
+            variant_paths = [os.path.join(output_folder, f"{file_id}_{variant}.jpg") for variant in VARIANTS]
+            if cache.variants_up_to_date(image_path, source_hash, variant_paths):
+                continue
+        with profiling.span("decode", filename):
+            image = cv2.imread(image_path)
 
-            low_res_snp_image = apply_salt_and_pepper_noise(low_res_image)
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_low_res_snp.jpg"), low_res_snp_image)
+        if image is None:
+            print(f"Warning: Could not load image {image_path}. Skipping...")
+            continue
 
-            # Add Gaussian noise and save
-            gauss_image = apply_gaussian_noise(image)
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_high_res_gauss.jpg"), gauss_image)
+        # The writes are nested in the preprocess span and also counted on their own
+        with profiling.span("preprocess", file_id):
+            for variant, variant_image in generate_variants(image, file_id, seed, buffers):
+                with profiling.span("write", f"{file_id}_{variant}.jpg"):
+                    cv2.imwrite(os.path.join(output_folder, f"{file_id}_{variant}.jpg"), variant_image)
 
-            low_res_gauss_image = apply_gaussian_noise(low_res_image)
-            cv2.imwrite(os.path.join(output_folder, f"{file_id}_low_res_gauss.jpg"), low_res_gauss_image)
+        if cache is not None:
+            cache.record_variants(image_path, source_hash)
 
+    if cache is not None:
+        cache.save()
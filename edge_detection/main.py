@@ -1,6 +1,9 @@
+import argparse
 import os
 
-from edge_detection import edge_detection
+from edge_detection import benchmark, edge_detection, filters, pipeline, profiling, pyramid, sweep
+from edge_detection import cache as rerun_cache
+from image_preprocess import noise
 from image_preprocess.process_images import process_images
 
 folders = ["mountain", "forest"]
@@ -8,8 +11,96 @@ subfolder = "image_preprocess/photos"
 output_base_folder = "input"
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes used for edge detection (1 = serial)")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="filter large rasters in tiles of this many pixels per side (default: whole image); "
+                             ".npy rasters in input/ are then read block by block")
+    parser.add_argument("--precision", choices=filters.PRECISIONS, default="float64",
+                        help="arithmetic used for the gradient filters (see edge_detection.precision for the accuracy report)")
+    parser.add_argument("--filter-bank", action="store_true",
+                        help="compute all filters of an image in one call, timed as a whole")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed calls before measuring a filter")
+    parser.add_argument("--min-iterations", type=int, default=10)
+    parser.add_argument("--max-iterations", type=int, default=100)
+    parser.add_argument("--target-relative-error", type=float, default=0.02,
+                        help="stop measuring once the 95%% confidence interval is this close to the mean")
+    parser.add_argument("--disable-gc", action="store_true", help="disable garbage collection while measuring")
+    parser.add_argument("--pin-cpu", type=int, default=None, help="pin a serial run to this CPU while measuring")
+    parser.add_argument("--timing-fraction", type=float, default=1.0,
+                        help="fraction of images that are benchmarked; the rest are filtered once (0 = production mode)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse preprocessed variants and filter outputs of unchanged inputs from this directory")
+    parser.add_argument("--cache-max-bytes", type=int, default=rerun_cache.DEFAULT_MAX_BYTES,
+                        help="evict least recently used cached outputs above this size")
+    parser.add_argument("--seed", type=int, default=noise.DEFAULT_SEED, help="seed of the generated noise variants")
+    parser.add_argument("--streaming", action="store_true",
+                        help="hand the generated variants to edge detection in memory instead of through input/")
+    parser.add_argument("--no-write-variants", action="store_true",
+                        help="in streaming mode, do not write the variants to input/ at all")
+    parser.add_argument("--no-json", action="store_true",
+                        help="only write the columnar results store (output/results), not output/results.json")
+    parser.add_argument("--inline-metrics", action="store_true",
+                        help="compute MSE/PSNR/SSIM against Canny from the in-memory filter outputs")
+    parser.add_argument("--edge-metrics", action="store_true",
+                        help="with --inline-metrics, also compute precision/recall/F1 of the edge maps")
+    parser.add_argument("--sweep", action="append", default=None, metavar="FILTER:PARAM=V1,V2;...",
+                        help="instead of the default filters, run every combination of the given parameters "
+                             "(repeatable, e.g. canny:threshold1=50,100;threshold2=150,200), see output/sweep")
+    parser.add_argument("--pyramid-levels", type=int, default=None,
+                        help="instead of the default run, apply the filter bank to this many pyramid levels of "
+                             "every image (each level half the size of the previous one), see output/pyramid")
+    parser.add_argument("--raw-outputs", action="store_true",
+                        help="also store every filter output in its native dtype as .npy next to the JPEG")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep the results of an interrupted run in output/results and only process the rest")
+    parser.add_argument("--checkpoint-every", type=int, default=64,
+                        help="make the written images and results durable after this many images")
+    parser.add_argument("--profile", default=None, metavar="TRACE_JSON",
+                        help="record the pipeline stages and write them to this Chrome trace file")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, also record the memory high-water mark of every stage")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.configure(memory=args.profile_memory)
 
-    for folder in folders:
-        process_images(os.path.join(subfolder, folder), os.path.join(output_base_folder, folder))
+    try:
+        benchmark_config = benchmark.BenchmarkConfig(warmup=args.warmup, min_iterations=args.min_iterations,
+                                                     max_iterations=args.max_iterations,
+                                                     target_relative_error=args.target_relative_error,
+                                                     disable_gc=args.disable_gc, cpu=args.pin_cpu)
+    except ValueError as error:
+        parser.error(str(error))
+    run_kwargs = dict(workers=args.workers, tile_size=args.tile_size, precision=args.precision,
+                      use_filter_bank=args.filter_bank, benchmark_config=benchmark_config,
+                      timing_fraction=args.timing_fraction, cache_dir=args.cache_dir,
+                      cache_max_bytes=args.cache_max_bytes, export_json=not args.no_json,
+                      inline_metrics=args.inline_metrics, edge_metrics=args.edge_metrics,
+                      raw_outputs=args.raw_outputs, resume=args.resume, checkpoint_every=args.checkpoint_every)
 
-    edge_detection.run()
\ No newline at end of file
+    if args.sweep or args.pyramid_levels:
+        for folder in folders:
+            process_images(os.path.join(subfolder, folder), os.path.join(output_base_folder, folder),
+                           cache_dir=args.cache_dir, seed=args.seed)
+
+        mode_kwargs = dict(workers=args.workers, precision=args.precision, benchmark_config=benchmark_config,
+                           timing_fraction=args.timing_fraction, export_json=not args.no_json,
+                           inline_metrics=args.inline_metrics, edge_metrics=args.edge_metrics)
+        if args.sweep:
+            sweep.run_sweep(sweep.parse_grid(args.sweep), **mode_kwargs)
+        else:
+            pyramid.run_pyramid(args.pyramid_levels, **mode_kwargs)
+    elif args.streaming:
+        photo_folders = {folder: os.path.join(subfolder, folder) for folder in folders}
+        pipeline.run_streaming(photo_folders, output_base_folder, seed=args.seed,
+                               write_variants=not args.no_write_variants, **run_kwargs)
+    else:
+        for folder in folders:
+            process_images(os.path.join(subfolder, folder), os.path.join(output_base_folder, folder),
+                           cache_dir=args.cache_dir, seed=args.seed)
+
+        edge_detection.run(**run_kwargs)
+
+    if args.profile:
+        profiling.finish(args.profile)
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+from image_result import ImageResult
+
+# Columnar aggregation of results: every group-by is a handful of numpy passes over whole columns,
+# independent of the number of groups.
+TIME_COLUMNS = {
+    'roberts': 'time_roberts',
+    'prewitt': 'time_prewitt',
+    'sobel': 'time_sobel',
+    'robinson': 'time_robinson',
+    'laplace': 'time_laplace',
+    'canny': 'time_canny',
+}
+# The result fields the aggregations read
+COLUMNS = ['id', 'original_path', 'is_high_resolution', 'is_ai_generated', 'is_gauss_noise',
+           'is_salt_and_pepper_noise', *TIME_COLUMNS.values()]
+DEFAULT_STATS = ('mean', 'median', 'p95', 'count')
+
+
+def to_columns(results: list[ImageResult]) -> dict:
+    return {name: np.array([getattr(result, name) for result in results]) for name in COLUMNS}
+
+
+def add_derived_columns(columns: dict) -> dict:
+    paths = np.asarray(columns['original_path'], dtype=str)
+    columns['folder'] = np.array([os.path.basename(os.path.dirname(path.replace('\\', '/'))) for path in paths])
+    columns['noise'] = np.select([columns['is_gauss_noise'], columns['is_salt_and_pepper_noise']],
+                                 ['gauss', 'snp'], 'none')
+    columns['resolution'] = np.where(columns['is_high_resolution'], 'high', 'low')
+    # The image type used by the report: noise first, then resolution of the noise-free images
+    columns['image_type'] = np.select(
+        [columns['is_gauss_noise'], columns['is_salt_and_pepper_noise'], columns['is_high_resolution']],
+        ['gauss_noise', 'salt_and_pepper_noise', 'original'], 'low_resolution')
+    return columns
+
+
+def melt_times(columns: dict, keys: list[str]) -> dict:
+    # One row per (result, filter): the key columns are repeated and the time_* columns stacked into 'time'
+    filters = list(TIME_COLUMNS)
+    count = len(columns[TIME_COLUMNS[filters[0]]])
+    long = {key: np.tile(np.asarray(columns[key]), len(filters)) for key in keys}
+    long['filter'] = np.repeat(np.array(filters), count)
+    long['time'] = np.concatenate([np.asarray(columns[TIME_COLUMNS[name]], dtype=np.float64) for name in filters])
+    return long
+
+
+def _sorted_percentile(values, starts, counts, q):
+    # Linear interpolation between the closest ranks, like np.percentile, for every group at once
+    position = starts + (counts - 1) * q
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def group_by(columns: dict, keys: list[str], value: str, stats=DEFAULT_STATS) -> dict:
+    values = np.asarray(columns[value], dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    uniques, codes = zip(*(np.unique(np.asarray(columns[key]), return_inverse=True) for key in keys))
+    group_codes = np.ravel_multi_index([code.ravel() for code in codes], [len(unique) for unique in uniques])
+    group_ids, group_index, counts = np.unique(group_codes, return_inverse=True, return_counts=True)
+
+    aggregated = {}
+    if 'count' in stats:
+        aggregated['count'] = counts
+    if 'mean' in stats:
+        aggregated['mean'] = np.bincount(group_index, weights=values) / counts
+    percentiles = {stat: float(stat[1:]) / 100 for stat in stats if stat.startswith('p') and stat[1:].isdigit()}
+    if 'median' in stats:
+        percentiles['median'] = 0.5
+    if percentiles:
+        order = np.lexsort((values, group_index))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for stat, q in percentiles.items():
+            aggregated[stat] = _sorted_percentile(values[order], starts, counts, q)
+
+    key_values = np.unravel_index(group_ids, [len(unique) for unique in uniques])
+    groups = {}
+    for group in range(len(group_ids)):
+        key = tuple(unique[index[group]].item() for unique, index in zip(uniques, key_values))
+        groups[key] = {stat: aggregated[stat][group].item() for stat in stats}
+    return groups
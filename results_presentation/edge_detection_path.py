@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The edge_detection package lives next to this directory and is not installed. Every module here that imports it
+# imports this module first, so the import does not depend on which module happened to be imported before.
+EDGE_DETECTION_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'edge_detection')
+if EDGE_DETECTION_ROOT not in sys.path:
+    sys.path.append(EDGE_DETECTION_ROOT)
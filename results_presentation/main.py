@@ -1,112 +1,127 @@
+import argparse
 import json
 import os
+import re
 
-import cv2
-
+import edge_detection_path  # puts the edge_detection package on sys.path
 from image_result import ImageResult
+import aggregation
+import metrics
+import thumbnails
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
+
+from edge_detection import profiling, results_store
+from template.compiler import compile_template
 
 RESULTS_JSON_PATH = os.path.join('..', 'output', 'results.json')
+RESULTS_STORE_PATH = os.path.join('..', 'output', 'results')
 OUTPUT_HTML_FILE = 'output.html'
 GALLERY_TEMPLATE_FILE = 'output_template.html'
+GALLERY_PAGE_TEMPLATE_FILE = 'gallery_template.html'
+GALLERY_PAGE_FILE = 'gallery_{page}.html'
+GALLERY_PAGE_PATTERN = re.compile(r'gallery_(\d+)\.html')
+GALLERY_PAGE_SIZE = 100
+
+GALLERY_COLUMNS = ["original", "roberts", "prewitt", "sobel", "robinson", "laplace", "canny"]
+
+def gallery_image(path: str, alt: str, previews: dict = None) -> str:
+    # The gallery shows the smallest preview; the full resolution image is only loaded when opened
+    levels = (previews or {}).get(path)
+    if not levels:
+        return f'<img src="{path}" alt="{alt}" onclick="openModal(\'{path}\')">'
+    sizes = sorted(levels)
+    srcset = ", ".join(f"{levels[size]} {size}w" for size in sizes)
+    return (f'<img src="{levels[sizes[0]]}" srcset="{srcset}" sizes="{sizes[0]}px" loading="lazy" alt="{alt}" '
+            f'onclick="openModal(\'{path}\')">')
 
-def generate_gallery(results: list[ImageResult]):
-    image_rows = ""
+
+def gallery_rows(results: list[ImageResult], previews: dict = None):
     for result in results:
-        row_html = f'''
+        yield f'''
             <tr class="image-row">
                 <td>
                     {result.id}
                 </td>
                 <td>
-                    <img src="{result.original_path}" alt="Original" onclick="openModal('{result.original_path}')">
+                    {gallery_image(result.original_path, 'Original', previews)}
                 </td>
                 <td>
-                    <img src="{result.roberts_path}" alt="Transformed roberts" onclick="openModal('{result.roberts_path}')">
+                    {gallery_image(result.roberts_path, 'Transformed roberts', previews)}
                 </td>
                 <td>
-                    <img src="{result.prewitt_path}" alt="Transformed prewitt" onclick="openModal('{result.prewitt_path}')">
+                    {gallery_image(result.prewitt_path, 'Transformed prewitt', previews)}
                 </td>
                 <td>
-                    <img src="{result.sobel_path}" alt="Transformed sobel" onclick="openModal('{result.sobel_path}')">
+                    {gallery_image(result.sobel_path, 'Transformed sobel', previews)}
                 </td>
                 <td>
-                    <img src="{result.robinson_path}" alt="Transformed robinson" onclick="openModal('{result.robinson_path}')">
+                    {gallery_image(result.robinson_path, 'Transformed robinson', previews)}
                 </td>
                 <td>
-                    <img src="{result.laplace_path}" alt="Transformed laplace" onclick="openModal('{result.laplace_path}')">
+                    {gallery_image(result.laplace_path, 'Transformed laplace', previews)}
                 </td>
                 <td>
-                    <img src="{result.canny_path}" alt="Transformed canny" onclick="openModal('{result.canny_path}')">
+                    {gallery_image(result.canny_path, 'Transformed canny', previews)}
                 </td>
             </tr>'''
 
-        image_rows += row_html
-    return image_rows
-
-
-def calculate_average_times(results: list[ImageResult]) -> dict:
-    average_results = {
-        'time_roberts': sum([r.time_roberts for r in results]) / len(results),
-        'time_prewitt': sum([r.time_prewitt for r in results]) / len(results),
-        'time_sobel': sum([r.time_sobel for r in results]) / len(results),
-        'time_robinson': sum([r.time_robinson for r in results]) / len(results),
-        'time_laplace': sum([r.time_laplace for r in results]) / len(results),
-        'time_canny': sum([r.time_canny for r in results]) / len(results)
-    }
 
-    return average_results
-
-
-def generate_average_times_per_image_type(results: list[ImageResult]) -> dict:
-    avg_times_per_type = {
-        'original': {'time_roberts': 0, 'time_prewitt': 0, 'time_sobel': 0, 'time_robinson': 0, 'time_laplace': 0,
-                     'time_canny': 0},
-        'gauss_noise': {'time_roberts': 0, 'time_prewitt': 0, 'time_sobel': 0, 'time_robinson': 0, 'time_laplace': 0,
-                        'time_canny': 0},
-        'salt_and_pepper_noise': {'time_roberts': 0, 'time_prewitt': 0, 'time_sobel': 0, 'time_robinson': 0,
-                                  'time_laplace': 0, 'time_canny': 0},
-        'low_resolution': {'time_roberts': 0, 'time_prewitt': 0, 'time_sobel': 0, 'time_robinson': 0, 'time_laplace': 0,
-                           'time_canny': 0},
-    }
-
-    for result in results:
-        if result.is_gauss_noise:
-            avg_times_per_type['gauss_noise']['time_roberts'] += result.time_roberts
-            avg_times_per_type['gauss_noise']['time_prewitt'] += result.time_prewitt
-            avg_times_per_type['gauss_noise']['time_sobel'] += result.time_sobel
-            avg_times_per_type['gauss_noise']['time_robinson'] += result.time_robinson
-            avg_times_per_type['gauss_noise']['time_laplace'] += result.time_laplace
-            avg_times_per_type['gauss_noise']['time_canny'] += result.time_canny
-        elif result.is_salt_and_pepper_noise:
-            avg_times_per_type['salt_and_pepper_noise']['time_roberts'] += result.time_roberts
-            avg_times_per_type['salt_and_pepper_noise']['time_prewitt'] += result.time_prewitt
-            avg_times_per_type['salt_and_pepper_noise']['time_sobel'] += result.time_sobel
-            avg_times_per_type['salt_and_pepper_noise']['time_robinson'] += result.time_robinson
-            avg_times_per_type['salt_and_pepper_noise']['time_laplace'] += result.time_laplace
-            avg_times_per_type['salt_and_pepper_noise']['time_canny'] += result.time_canny
-        elif result.is_high_resolution:
-            avg_times_per_type['original']['time_roberts'] += result.time_roberts
-            avg_times_per_type['original']['time_prewitt'] += result.time_prewitt
-            avg_times_per_type['original']['time_sobel'] += result.time_sobel
-            avg_times_per_type['original']['time_robinson'] += result.time_robinson
-            avg_times_per_type['original']['time_laplace'] += result.time_laplace
-            avg_times_per_type['original']['time_canny'] += result.time_canny
-        elif not result.is_high_resolution:
-            avg_times_per_type['low_resolution']['time_roberts'] += result.time_roberts
-            avg_times_per_type['low_resolution']['time_prewitt'] += result.time_prewitt
-            avg_times_per_type['low_resolution']['time_sobel'] += result.time_sobel
-            avg_times_per_type['low_resolution']['time_robinson'] += result.time_robinson
-            avg_times_per_type['low_resolution']['time_laplace'] += result.time_laplace
-            avg_times_per_type['low_resolution']['time_canny'] += result.time_canny
-
-    num_results = len(results)
-    for image_type, times in avg_times_per_type.items():
-        for key in times:
-            times[key] /= num_results
-
-    return avg_times_per_type
+def gallery_page_path(page: int) -> str:
+    # The first page is shown inline in the report itself
+    return OUTPUT_HTML_FILE if page == 1 else GALLERY_PAGE_FILE.format(page=page)
+
+
+def generate_gallery_pages(page: int, page_count: int) -> str:
+    if page_count <= 1:
+        return ""
+    links = []
+    for other in range(1, page_count + 1):
+        if other == page:
+            links.append(f'<span>{other}</span>')
+        else:
+            links.append(f'<a href="{gallery_page_path(other)}">{other}</a>')
+    return " ".join(links)
+
+
+def build_previews(results: list[ImageResult], sizes=thumbnails.THUMBNAIL_SIZES) -> dict:
+    paths = [getattr(result, f"{column}_path") for result in results for column in GALLERY_COLUMNS]
+    return thumbnails.build_thumbnails(paths, sizes)
+
+
+def write_gallery_pages(results: list[ImageResult], page_size: int = GALLERY_PAGE_SIZE, previews: dict = None) -> int:
+    page_count = max(1, -(-len(results) // page_size))
+    template = compile_template(GALLERY_PAGE_TEMPLATE_FILE)
+    for page in range(2, page_count + 1):
+        start = (page - 1) * page_size
+        with open(gallery_page_path(page), "w", encoding="utf-8") as file:
+            template.render_to(file, {
+                'page': page,
+                'page_count': page_count,
+                'report': OUTPUT_HTML_FILE,
+                'gallery_pages': generate_gallery_pages(page, page_count),
+                'gallery': gallery_rows(results[start:start + page_size], previews),
+            })
+    # Pages past the last one are left over from an earlier report with more results
+    for name in os.listdir('.'):
+        match = GALLERY_PAGE_PATTERN.fullmatch(name)
+        if match and int(match.group(1)) > page_count:
+            os.remove(name)
+    return page_count
+
+
+def calculate_average_times(columns: dict) -> dict:
+    groups = aggregation.group_by(aggregation.melt_times(columns, []), ['filter'], 'time', stats=('mean',))
+    return {time_column: groups.get((name,), {'mean': 0})['mean']
+            for name, time_column in aggregation.TIME_COLUMNS.items()}
+
+
+def generate_average_times_per_image_type(columns: dict) -> dict:
+    # Averaged over the images of each type (not over all images)
+    groups = aggregation.group_by(aggregation.melt_times(columns, ['image_type']), ['image_type', 'filter'], 'time',
+                                  stats=('mean',))
+    return {image_type: {time_column: groups.get((image_type, name), {'mean': 0})['mean']
+                         for name, time_column in aggregation.TIME_COLUMNS.items()}
+            for image_type in ['original', 'gauss_noise', 'salt_and_pepper_noise', 'low_resolution']}
 
 def generate_chart_html(times: dict) -> str:
     chart_data = {
@@ -217,41 +232,16 @@ def generate_chart_html(times: dict) -> str:
 
     return chart_html
 
-def mse(image1, image2):
-    return np.mean((image1 - image2) ** 2)
-
-def psnr(image1, image2, max_pixel=255):
-    mse_value = mse(image1, image2)
-    if mse_value == 0:
-        return 100
-    return 20 * np.log10(max_pixel / np.sqrt(mse_value))
-
-def calculate_ssim(image1, image2):
-    return ssim(image1, image2)
-
-
 def generate_comparison_results(results):
-    comparison_results = {
-        "roberts": {"mse": [], "psnr": [], "ssim": []},
-        "prewitt": {"mse": [], "psnr": [], "ssim": []},
-        "sobel": {"mse": [], "psnr": [], "ssim": []},
-        "robinson": {"mse": [], "psnr": [], "ssim": []},
-        "laplace": {"mse": [], "psnr": [], "ssim": []}
-    }
-
-    for result in results:
-        canny_image = load_image(result.canny_path)
-
-        for algorithm in comparison_results.keys():
-            algorithm_image = load_image(getattr(result, f"{algorithm}_path"))
-
-            mse_value = mse(algorithm_image, canny_image)
-            psnr_value = psnr(algorithm_image, canny_image)
-            ssim_value = calculate_ssim(algorithm_image, canny_image)
+    comparison_results = {algorithm: {metric: [] for metric in metrics.METRICS}
+                          for algorithm in metrics.COMPARED_FILTERS}
 
-            comparison_results[algorithm]["mse"].append(mse_value)
-            comparison_results[algorithm]["psnr"].append(psnr_value)
-            comparison_results[algorithm]["ssim"].append(ssim_value)
+    with profiling.span("metrics", "compute_metrics"):
+        computed_metrics = metrics.compute_metrics(results)
+    for result_metrics in computed_metrics:
+        for algorithm, values in result_metrics.items():
+            for metric, value in values.items():
+                comparison_results[algorithm][metric].append(value)
 
     avg_comparison_results = {}
     for algorithm, values in comparison_results.items():
@@ -263,10 +253,6 @@ def generate_comparison_results(results):
 
     return avg_comparison_results
 
-def load_image(image_path):
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    return image
-
 
 def generate_comparison_html(comparison_results):
     html_content = """
@@ -300,38 +286,46 @@ def generate_comparison_html(comparison_results):
 
     return html_content
 
-def generate_results_html(results: list[ImageResult]):
-    with open(GALLERY_TEMPLATE_FILE, 'r', encoding="utf-8") as template_file:
-        html_template = template_file.read()
-
-    gallery = generate_gallery(results)
-    html_content = html_template.replace("{{gallery}}", gallery)
-
-    avg_times = calculate_average_times(results)
-    html_content = html_content.replace("{{time_roberts}}", str(avg_times['time_roberts']))
-    html_content = html_content.replace("{{time_prewitt}}", str(avg_times['time_prewitt']))
-    html_content = html_content.replace("{{time_sobel}}", str(avg_times['time_sobel']))
-    html_content = html_content.replace("{{time_robinson}}", str(avg_times['time_robinson']))
-    html_content = html_content.replace("{{time_laplace}}", str(avg_times['time_laplace']))
-    html_content = html_content.replace("{{time_canny}}", str(avg_times['time_canny']))
-
-    avg_times_per_type = generate_average_times_per_image_type(results)
-    html_content = html_content.replace("{{chart_all}}", generate_chart_html(avg_times_per_type))
+def generate_results_html(results: list[ImageResult], columns: dict = None,
+                          page_size: int = GALLERY_PAGE_SIZE, thumbnail_sizes=thumbnails.THUMBNAIL_SIZES):
+    if columns is None:
+        columns = aggregation.to_columns(results)
+    aggregation.add_derived_columns(columns)
+
+    previews = None
+    if thumbnail_sizes:
+        with profiling.span("encode", "thumbnails"):
+            previews = build_previews(results, thumbnail_sizes)
+    with profiling.span("report", "gallery pages"):
+        page_count = write_gallery_pages(results, page_size, previews)
+    values = {
+        'gallery': gallery_rows(results[:page_size], previews),
+        'gallery_pages': generate_gallery_pages(1, page_count),
+        'chart_all': lambda: generate_chart_html(generate_average_times_per_image_type(columns)),
+    }
+    values.update(calculate_average_times(columns))
 
     COMPARISON = True
     if COMPARISON:
-        comparison_results = generate_comparison_results(results)
-        comparison_html = generate_comparison_html(comparison_results)
-        html_content = html_content.replace("{{comparison}}", comparison_html)
+        values['comparison'] = lambda: generate_comparison_html(generate_comparison_results(results))
+    else:
+        values['comparison'] = ""
 
-    with open(OUTPUT_HTML_FILE, "w") as file:
-                file.write(html_content)
+    # Sections are streamed as they are computed, so a failure must not leave a truncated report behind
+    partial_path = OUTPUT_HTML_FILE + '.part'
+    with profiling.span("report", OUTPUT_HTML_FILE), open(partial_path, "w", encoding="utf-8") as file:
+        compile_template(GALLERY_TEMPLATE_FILE).render_to(file, values)
+    os.replace(partial_path, OUTPUT_HTML_FILE)
 
 
 def load_results(json_file: str) -> list[ImageResult]:
     with open(json_file, 'r') as file:
         data = json.load(file)
-    return [ImageResult.from_dict(item) for item in data]
+    return ImageResult.from_dicts(data, normalize_paths=True)
+
+
+def load_results_store(directory: str) -> list[ImageResult]:
+    return ImageResult.from_dicts(results_store.ResultsStore(directory).to_dicts(), normalize_paths=True)
 
 
 def save_results(results: list[ImageResult], json_file: str):
@@ -340,5 +334,24 @@ def save_results(results: list[ImageResult], json_file: str):
 
 
 if __name__ == "__main__":
-    results: list[ImageResult] = load_results(RESULTS_JSON_PATH)
-    generate_results_html(results)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", default=None, metavar="TRACE_JSON",
+                        help="record the report stages and write them to this Chrome trace file")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, also record the memory high-water mark of every stage")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.configure(memory=args.profile_memory)
+
+    with profiling.span("decode", "load results"):
+        if results_store.exists(RESULTS_STORE_PATH):
+            results: list[ImageResult] = load_results_store(RESULTS_STORE_PATH)
+            # The aggregations read the few columns they use directly from the store
+            columns = results_store.ResultsStore(RESULTS_STORE_PATH).columns(aggregation.COLUMNS)
+        else:
+            results: list[ImageResult] = load_results(RESULTS_JSON_PATH)
+            columns = None
+    generate_results_html(results, columns)
+
+    if args.profile:
+        profiling.finish(args.profile)
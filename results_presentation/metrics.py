@@ -0,0 +1,131 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import edge_detection_path  # puts the edge_detection package on sys.path
+from image_result import ImageResult
+from edge_detection.cache import file_hash
+from edge_detection.quality import compare, to_metric_image
+
+# Quality metrics of every filter output against the Canny output of the same image. Values are cached per
+# (output file, Canny file) content hash, so a report only computes metrics for outputs that changed. The hashes
+# are cached too: like for the thumbnails, a file is only hashed again when its mtime or size changed.
+# Results whose metrics were computed during edge detection (ImageResult.metrics) are used as they are, and
+# raw .npy outputs (ImageResult.raw_paths) are read instead of the JPEGs when they exist.
+COMPARED_FILTERS = ["roberts", "prewitt", "sobel", "robinson", "laplace"]
+# Names of the compared filters in ImageResult.metrics, which uses the edge detection filter names
+STORED_METRIC_NAMES = {"roberts": "roberts", "prewitt": "prewitt", "sobel": "sobel", "robinson": "robinson",
+                       "laplace": "laplacian"}
+METRICS = ["mse", "psnr", "ssim"]
+METRICS_VERSION = 2
+METRICS_CACHE_PATH = os.path.join('..', 'output', 'metrics_cache.json')
+HASH_THREADS = 8
+
+
+def load_image(image_path):
+    if image_path.endswith(".npy"):
+        # The exact output, neither compressed nor rounded and saturated to 8 bits
+        return to_metric_image(np.load(image_path, mmap_mode="r"))
+    return cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+
+def metric_path(result: ImageResult, name):
+    raw_path = result.raw_paths.get(STORED_METRIC_NAMES.get(name, name))
+    if raw_path is not None and os.path.exists(raw_path):
+        return raw_path
+    return getattr(result, f"{name}_path")
+
+
+def _image_metrics(task):
+    # One decoded Canny reference is shared by all outputs of the image
+    canny_path, paths = task
+    canny_image = load_image(canny_path)
+    return {key: compare(load_image(path), canny_image) for key, path in paths.items()}
+
+
+def _cache_key(output_hash, canny_hash):
+    return f"{output_hash}-{canny_hash}-v{METRICS_VERSION}"
+
+
+def load_cache(cache_path):
+    # {"files": {absolute path: {"hash", "mtime_ns", "size"}}, "metrics": {cache key: metrics}}
+    if not os.path.exists(cache_path):
+        return {"files": {}, "metrics": {}}
+    with open(cache_path, 'r') as cache_file:
+        cache = json.load(cache_file)
+    # Caches written before the file hashes were kept only hold the metrics
+    if "metrics" not in cache:
+        cache = {"files": {}, "metrics": cache}
+    return cache
+
+
+def save_cache(cache, cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temporary_path = f"{cache_path}.{os.getpid()}"
+    with open(temporary_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(temporary_path, cache_path)
+
+
+def stored_metrics(result: ImageResult):
+    if not all(STORED_METRIC_NAMES[name] in result.metrics for name in COMPARED_FILTERS):
+        return None
+    return {name: {metric: result.metrics[STORED_METRIC_NAMES[name]][metric] for metric in METRICS}
+            for name in COMPARED_FILTERS}
+
+
+def compute_metrics(results: list[ImageResult], workers=None, cache_path=METRICS_CACHE_PATH) -> list[dict]:
+    # Returns, per result, {filter: {"mse": ..., "psnr": ..., "ssim": ...}} for COMPARED_FILTERS
+    computed_metrics = [stored_metrics(result) for result in results]
+    results = [result for result, values in zip(results, computed_metrics) if values is None]
+    if results:
+        file_metrics = iter(_file_metrics(results, workers, cache_path))
+        computed_metrics = [next(file_metrics) if values is None else values for values in computed_metrics]
+    return computed_metrics
+
+
+def _changed_files(paths, files):
+    # Paths whose mtime or size differ from the cached entry, or that have none
+    changed = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = files.get(os.path.abspath(path))
+        if entry is None or (entry["mtime_ns"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            changed.append((path, stat))
+    return changed
+
+
+def _file_metrics(results, workers, cache_path):
+    cache = load_cache(cache_path)
+    files, cached_metrics = cache["files"], cache["metrics"]
+    paths = [{name: metric_path(result, name) for name in ["canny", *COMPARED_FILTERS]} for result in results]
+    unique_paths = sorted({path for result_paths in paths for path in result_paths.values()})
+    changed = _changed_files(unique_paths, files)
+    if changed:
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+            changed_hashes = executor.map(file_hash, [path for path, stat in changed])
+            for (path, stat), path_hash in zip(changed, changed_hashes):
+                files[os.path.abspath(path)] = {"hash": path_hash, "mtime_ns": stat.st_mtime_ns,
+                                                "size": stat.st_size}
+    hashes = {path: files[os.path.abspath(path)]["hash"] for path in unique_paths}
+
+    keys = [{name: _cache_key(hashes[result_paths[name]], hashes[result_paths["canny"]])
+             for name in COMPARED_FILTERS} for result_paths in paths]
+    tasks = []
+    for result_paths, result_keys in zip(paths, keys):
+        missing = {result_keys[name]: result_paths[name] for name in COMPARED_FILTERS
+                   if result_keys[name] not in cached_metrics}
+        if missing:
+            tasks.append((result_paths["canny"], missing))
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for computed in executor.map(_image_metrics, tasks, chunksize=max(1, len(tasks) // 64)):
+                cached_metrics.update(computed)
+    if tasks or changed:
+        save_cache(cache, cache_path)
+
+    return [{name: cached_metrics[result_keys[name]] for name in COMPARED_FILTERS} for result_keys in keys]
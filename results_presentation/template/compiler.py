@@ -0,0 +1,33 @@
+import functools
+import re
+
+PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+
+
+class CompiledTemplate:
+    def __init__(self, text: str):
+        # Even indices hold literal text, odd indices placeholder names
+        self.segments = PLACEHOLDER.split(text)
+
+    def render_to(self, file, values: dict):
+        for index, segment in enumerate(self.segments):
+            if index % 2 == 0:
+                file.write(segment)
+                continue
+            value = values.get(segment, "{{" + segment + "}}")
+            if callable(value):
+                value = value()
+            if isinstance(value, str):
+                file.write(value)
+            elif hasattr(value, '__iter__'):
+                # Generators of fragments are streamed instead of joined
+                for fragment in value:
+                    file.write(fragment)
+            else:
+                file.write(str(value))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(path: str) -> CompiledTemplate:
+    with open(path, 'r', encoding="utf-8") as template_file:
+        return CompiledTemplate(template_file.read())
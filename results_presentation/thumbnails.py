@@ -0,0 +1,148 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import edge_detection_path  # puts the edge_detection package on sys.path
+from edge_detection.cache import file_hash
+from edge_detection.image_result import probe_size
+from edge_detection.tiling import preview
+
+# Reduced-size previews of the gallery images. A preview is rebuilt only when its source changed: the source's
+# mtime and size are checked first and the content hash only when those differ. Previews are named after the
+# content hash, so identical sources share them. Several sizes form a pyramid, each level built from the one above.
+THUMBNAIL_DIR = os.path.join('..', 'output', 'thumbnails')
+THUMBNAIL_SIZES = (256,)
+THUMBNAIL_QUALITY = 80
+THUMBNAILS_VERSION = 1
+THUMBNAIL_MAX_BYTES = 1024 ** 3
+MANIFEST_FILE = 'manifest.json'
+# JPEG decoding can scale down by these factors directly, which is much cheaper than decoding at full size
+REDUCED_READ_MODES = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2}
+
+
+def thumbnail_name(source_hash, size):
+    return f"{source_hash}-{size}-v{THUMBNAILS_VERSION}.jpg"
+
+
+def _read_reduced(path, size):
+    if path.endswith('.npy'):
+        # Raster inputs of tiled runs, reduced tile by tile without reading them whole
+        return preview(np.load(path, mmap_mode='r'), max_size=size)
+    width, height = probe_size(path)
+    for factor, mode in REDUCED_READ_MODES.items():
+        if max(width, height) // factor >= size:
+            return cv2.imread(path, mode)
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def _resize(image, size):
+    height, width = image.shape[:2]
+    scale = size / max(width, height)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def _build(task):
+    source_path, source_hash, sizes, thumbnail_dir = task
+    image = _read_reduced(source_path, max(sizes))
+    levels = {}
+    for size in sorted(sizes, reverse=True):
+        image = _resize(image, size)
+        path = os.path.join(thumbnail_dir, thumbnail_name(source_hash, size))
+        temporary_path = f"{path}.{os.getpid()}.jpg"
+        cv2.imwrite(temporary_path, image, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        os.replace(temporary_path, path)
+        levels[str(size)] = path
+    return source_path, levels
+
+
+def load_manifest(thumbnail_dir):
+    manifest_path = os.path.join(thumbnail_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {"version": THUMBNAILS_VERSION, "sources": {}}
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("version") != THUMBNAILS_VERSION:
+        return {"version": THUMBNAILS_VERSION, "sources": {}}
+    return manifest
+
+
+def save_manifest(manifest, thumbnail_dir):
+    manifest_path = os.path.join(thumbnail_dir, MANIFEST_FILE)
+    temporary_path = f"{manifest_path}.{os.getpid()}"
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_path, manifest_path)
+
+
+def _up_to_date(entry, sizes):
+    return entry is not None and all(os.path.exists(entry["levels"].get(str(size), "")) for size in sizes)
+
+
+def evict(manifest, max_bytes, thumbnail_dir, used_since):
+    # Least recently used sources first; previews of the current report (used since used_since) and previews
+    # shared with a more recent source are kept
+    sources = manifest["sources"]
+    in_use = {}
+    for entry in sources.values():
+        for path in entry["levels"].values():
+            in_use[path] = max(in_use.get(path, 0), entry["last_used"])
+    # Previews of sources that have since changed are no longer referenced by any entry
+    for name in os.listdir(thumbnail_dir):
+        path = os.path.join(thumbnail_dir, name)
+        if name != MANIFEST_FILE and path not in in_use:
+            os.remove(path)
+    sizes = {path: os.path.getsize(path) for path in in_use if os.path.exists(path)}
+    total = sum(sizes.values())
+    for source_path, entry in sorted(sources.items(), key=lambda item: item[1]["last_used"]):
+        if total <= max_bytes or entry["last_used"] >= used_since:
+            break
+        del sources[source_path]
+        for path in entry["levels"].values():
+            if path in sizes and in_use[path] <= entry["last_used"]:
+                os.remove(path)
+                total -= sizes.pop(path)
+
+
+def build_thumbnails(paths, sizes=THUMBNAIL_SIZES, workers=None, thumbnail_dir=THUMBNAIL_DIR,
+                     max_bytes=THUMBNAIL_MAX_BYTES) -> dict:
+    # Returns {source path: {size: preview path}} for every source that exists
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    manifest = load_manifest(thumbnail_dir)
+    sources = manifest["sources"]
+    now = time.time()
+    tasks = []
+    for path in sorted(set(paths)):
+        if not os.path.exists(path):
+            continue
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = sources.get(key)
+        if entry is not None and (entry["mtime_ns"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            source_hash = file_hash(path)
+            entry = {**entry, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size} \
+                if entry["hash"] == source_hash else None
+        else:
+            source_hash = entry["hash"] if entry is not None else file_hash(path)
+        if _up_to_date(entry, sizes):
+            sources[key] = {**entry, "last_used": now}
+        else:
+            sources[key] = {"hash": source_hash, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                            "levels": {}, "last_used": now}
+            tasks.append((path, source_hash, tuple(sizes), thumbnail_dir))
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for source_path, levels in executor.map(_build, tasks, chunksize=max(1, len(tasks) // 64)):
+                sources[os.path.abspath(source_path)]["levels"].update(levels)
+
+    evict(manifest, max_bytes, thumbnail_dir, now)
+    save_manifest(manifest, thumbnail_dir)
+    return {path: {int(size): level_path for size, level_path in sources[os.path.abspath(path)]["levels"].items()}
+            for path in paths if os.path.abspath(path) in sources}